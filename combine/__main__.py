@@ -84,6 +84,7 @@ def irc(obj, daemon, repl_only):
         osu_client,
         obj.models,
         obj.model_cache_size,
+        obj.beatmap_cache_size,
         obj.token_secret,
         obj.upload_url,
         obj.train_queue,
@@ -172,9 +173,16 @@ def server(obj):
     build_app(
         model_cache_size=obj.model_cache_size,
         model_cache_dir=obj.models,
+        beatmap_cache_size=obj.beatmap_cache_size,
+        predict_batch_max_size=obj.predict_batch_max_size,
+        prediction_cache_size=obj.prediction_cache_size,
         replay_cache_dir=obj.replays,
+        max_replay_size=obj.max_replay_size,
         token_secret=obj.token_secret,
+        token_cache_size=obj.token_cache_size,
         client=obj.client,
+        beatmap_prefetch_workers=obj.beatmap_prefetch_workers,
+        api_requests_per_minute=obj.api_requests_per_minute,
         bot_user=obj.username,
         github_url=obj.github_url,
         email_address=obj.email_address,
@@ -184,21 +192,106 @@ def server(obj):
 
 
 @main.command()
+@click.option(
+    '--workers',
+    type=int,
+    help=(
+        'The number of jobs to train at once. Defaults to train_workers from'
+        ' the config.'
+    ),
+)
 @click.pass_obj
-def train(obj):
+def train(obj, workers):
     """Run the model training service with consumes tasks enqueued by the web
     server.
     """
     from .train import run_train_queue
 
+    if workers is None:
+        workers = obj.train_workers
+
+    gc_interval = obj.gc_interval_hours
+    if gc_interval is not None:
+        gc_interval *= 60 * 60
+
     run_train_queue(
         train_queue=obj.train_queue,
         replay_cache_dir=obj.replays,
         model_cache_dir=obj.models,
         client=obj.client,
+        preload_worker=obj.preload_train_worker,
+        workers=workers,
+        max_jobs_per_user=obj.max_train_jobs_per_user,
+        limits=obj.train_job_limits,
+        parse_processes=obj.replay_parse_processes,
+        gc_interval=gc_interval,
+    )
+
+
+@main.command('retrain-all')
+@click.option(
+    '--enqueue/--no-enqueue',
+    default=True,
+    help=(
+        'Only add a job for each user to the train queue for the train'
+        ' service. With --no-enqueue, also run jobs from the queue in this'
+        ' process until none are left.'
+    ),
+)
+@click.option(
+    '--workers',
+    type=int,
+    help=(
+        'The number of jobs to run at once with --no-enqueue. Defaults to the'
+        ' number of cpus.'
+    ),
+)
+@click.pass_obj
+def retrain_all(obj, enqueue, workers):
+    """Retrain every user who does not have a model for the current model
+    version. This may be interrupted and run again to resume.
+    """
+    from .retrain import retrain_all
+
+    retrain_all(
+        replay_cache_dir=obj.replays,
+        model_cache_dir=obj.models,
+        client=obj.client,
+        train_queue=obj.train_queue,
+        enqueue=enqueue,
+        workers=workers,
+        preload_worker=obj.preload_train_worker,
+        max_jobs_per_user=obj.max_train_jobs_per_user,
+        limits=obj.train_job_limits,
+        parse_processes=obj.replay_parse_processes,
     )
 
 
+@main.command()
+@click.option(
+    '--archive-replays/--no-archive-replays',
+    default=True,
+    help=(
+        'Move replays older than the longest age each user has trained with'
+        ' into compressed per-user archives.'
+    ),
+)
+@click.pass_obj
+def gc(obj, archive_replays):
+    """Remove models and parsed replays for old model versions and archive
+    replays which are too old to be trained on.
+    """
+    from .retention import collect_garbage
+
+    reclaimed = collect_garbage(
+        replay_cache_dir=obj.replays,
+        model_cache_dir=obj.models,
+        train_queue=obj.train_queue,
+        archive_replays=archive_replays,
+    )
+    click.echo(f'reclaimed {reclaimed} bytes')
+
+
 @main.command('train-single')
 @click.option(
     '--user',
@@ -214,26 +307,46 @@ def train(obj):
     '--age',
     help='The age of replays to consider when training.',
 )
+@click.option(
+    '--processes',
+    type=int,
+    help=(
+        'The number of processes to parse replays with. Defaults to the'
+        ' number of cpus.'
+    ),
+)
 @click.pass_obj
-def train_single(obj, user, replays, age):
+def train_single(obj, user, replays, age, processes):
     """Manually train the model for a given user.
     """
     import os
-    import pickle
 
+    from lain import ErrorModel
     import pandas as pd
-    from slider.model import train_from_replay_directory
+
+    from .model_artifact import export_model
+    from .replay_store import load_replay_directory
+    from .utils import model_path
 
     if age is not None:
         age = pd.Timedelta(age)
 
-    m = train_from_replay_directory(
+    if processes is None:
+        processes = os.cpu_count()
+
+    m = ErrorModel()
+    m.fit(load_replay_directory(
         replays,
         client=obj.client,
         age=age,
-    )
-    with open(os.path.join(obj.models, user), 'wb') as f:
-        pickle.dump(m, f)
+        save=True,
+        processes=processes,
+    ))
+
+    path = model_path(obj.models, user)
+    path.mkdir(parents=True, exist_ok=True)
+    m.save_path(path)
+    export_model(m, obj.models, user)
 
 
 @main.command(name='check-ip')
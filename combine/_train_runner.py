@@ -21,6 +21,31 @@ import click
     '--age',
     help='The maximum age of replays to include in the training data.'
 )
+@click.option(
+    '--incremental/--no-incremental',
+    default=False,
+    help=(
+        'Fine-tune the existing model on only the new replays instead of'
+        ' training from scratch. This is experimental: it assumes that'
+        ' ErrorModel.fit continues from the loaded weights, which has not'
+        ' been verified against lain, so the train service never uses it.'
+    ),
+)
+@click.option(
+    '--full-retrain-interval',
+    type=int,
+    default=10,
+    help=(
+        'The number of incremental runs after which the model is trained'
+        ' from scratch again.'
+    ),
+)
+@click.option(
+    '--parse-processes',
+    type=int,
+    default=1,
+    help='The number of processes to parse replays with.',
+)
 @click.option(
     '--library',
     help='The path to the library.',
@@ -31,36 +56,268 @@ import click
     help='The osu! API key to use when creating the client.',
     required=True,
 )
+@click.option(
+    '--train-queue-db',
+    help='The path to the train queue to record the progress of the job in.',
+)
+@click.option(
+    '--job-id',
+    type=int,
+    help='The id of the job in the train queue.',
+)
 def run_job(user,
             replay_cache_dir,
             model_cache_dir,
             age,
+            incremental,
+            full_retrain_interval,
+            parse_processes,
             library,
-            api_key):
+            api_key,
+            train_queue_db,
+            job_id):
+    train(
+        user=user,
+        replay_cache_dir=replay_cache_dir,
+        model_cache_dir=model_cache_dir,
+        age=age,
+        incremental=incremental,
+        full_retrain_interval=full_retrain_interval,
+        parse_processes=parse_processes,
+        library=library,
+        api_key=api_key,
+        train_queue_db=train_queue_db,
+        job_id=job_id,
+    )
+
+
+# The modules imported by ``train``. These are imported once by the
+# forkserver in worker mode so that each job does not need to pay for them.
+preload_modules = [
+    'lain',
+    'numpy',
+    'pandas',
+    'slider',
+    'combine.logging',
+    'combine.manifest',
+    'combine.replay_cache',
+    'combine.replay_store',
+    'combine.train',
+    'combine.utils',
+]
+
+
+def run_in_worker(stderr_path, started_at, usage, limits, kwargs):
+    """The entry point for a train job forked from a preloaded worker.
+
+    Parameters
+    ----------
+    stderr_path : str
+        The path to write stderr to.
+    started_at : multiprocessing.Value
+        Set to the unix time when the job started, after the fork.
+    usage : multiprocessing.Array
+        Set to the peak rss in bytes and the cpu time in seconds used by the
+        job and its children when it exits.
+    limits : JobLimits
+        The niceness and cpu affinity to apply to the job before it starts.
+    kwargs : dict[str, any]
+        The arguments to forward to ``train``.
+    """
+    import os
+    import resource
+    import sys
+    import time
+
+    from combine.limits import apply_limits
+
+    started_at.value = time.time()
+    # lead a new session so that the job can be killed along with its replay
+    # parsing processes
+    os.setsid()
+
+    fd = os.open(stderr_path, os.O_WRONLY)
+    os.dup2(fd, sys.stderr.fileno())
+    os.close(fd)
+
+    # apply the limits in the job so that a failure fails only this job
+    apply_limits(0, limits)
+
+    try:
+        train(**kwargs)
+    finally:
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        usage[0] = max(rusage.ru_maxrss, children.ru_maxrss) * 1024
+        usage[1] = (
+            rusage.ru_utime + rusage.ru_stime +
+            children.ru_utime + children.ru_stime
+        )
+
+
+def train(user,
+          replay_cache_dir,
+          model_cache_dir,
+          age,
+          library,
+          api_key,
+          incremental=False,
+          full_retrain_interval=10,
+          parse_processes=1,
+          train_queue_db=None,
+          job_id=None):
+    """Train and save the model for a single user.
+
+    Parameters
+    ----------
+    user : str
+        The user to train for.
+    replay_cache_dir : path-like
+        The root replay directory.
+    model_cache_dir : path-like
+        The root model directory.
+    age : str or None
+        The maximum age of replays to include in the training data.
+    library : path-like
+        The path to the beatmap library.
+    api_key : str
+        The osu! API key.
+    incremental : bool, optional
+        Fine-tune the existing model on only the new replays? This is
+        experimental; see ``--incremental``.
+    full_retrain_interval : int, optional
+        The number of incremental runs after which the model is trained from
+        scratch again.
+    parse_processes : int, optional
+        The number of processes to parse replays with.
+    train_queue_db : path-like, optional
+        The path to the train queue to record the job's progress and stage
+        timings in.
+    job_id : int, optional
+        The id of the job in the train queue.
+    """
     import pathlib
 
     from lain import ErrorModel
-    from lain.train import load_replay_directory
     import pandas as pd
     from slider import Client, Library
 
-    from combine.utils import model_path
+    from combine.logging import log
+    from combine.manifest import ReplayManifest
+    from combine.model_artifact import export_model
+    from combine.replay_cache import ParsedReplayCache
+    from combine.replay_store import load_replays
+    from combine.train import JobProgress, TrainQueue
+    from combine.utils import TrainingState, model_path, training_fingerprint
+
+    if job_id is not None:
+        progress = JobProgress(TrainQueue(train_queue_db), job_id)
+    else:
+        progress = JobProgress(None, None)
 
     osu_client = Client(Library(library), api_key)
-    replays = load_replay_directory(
-        pathlib.Path(replay_cache_dir) / user,
-        client=osu_client,
-        age=pd.Timedelta(age) if age is not None else None,
-        save=True,
-        verbose=True,
-    )
+    user_replays = pathlib.Path(replay_cache_dir) / user
+
+    # the queue stores a missing age as the string 'None'
+    if age is not None and age != 'None':
+        age = pd.Timedelta(age)
+    else:
+        age = None
+
+    # use the manifest to pick the replays to train on so that we only parse
+    # the replays which are young enough
+    with ReplayManifest(user_replays) as manifest:
+        with progress.stage('sync'):
+            added = manifest.sync()
+        if added:
+            log.info('added {added} replays to the manifest', added=added)
 
-    model = ErrorModel()
-    model.fit(replays)
+        manifest.record_training_age(age)
+        digests = manifest.select(age=age)
+        user_models = model_path(model_cache_dir, user)
+        fingerprint = training_fingerprint(digests)
+        state = TrainingState.read(model_cache_dir, user)
+        if state is not None and not user_models.exists():
+            state = None
 
-    user_models = model_path(model_cache_dir, user)
-    user_models.mkdir(parents=True, exist_ok=True)
-    model.save_path(user_models)
+        if state is not None and fingerprint == state.fingerprint:
+            log.info('training replays are unchanged, keeping current model')
+            return
+
+        # Fine-tune the existing model on the new replays when possible.
+        # Every ``full_retrain_interval`` runs, train from scratch to keep
+        # the model from drifting.
+        warm_start = (
+            incremental and
+            state is not None and
+            state.incremental_runs < full_retrain_interval
+        )
+        if warm_start:
+            to_load = [d for d in digests if d not in state.digests]
+        else:
+            to_load = digests
+
+        log.info(
+            'loading {selected} of {total} replays ({mode})',
+            selected=len(to_load),
+            total=len(manifest),
+            mode='incremental' if warm_start else 'full',
+        )
+
+        with progress.stage('load', total=len(to_load)):
+            loaded = load_replays(
+                user_replays,
+                to_load,
+                client=osu_client,
+                save=True,
+                cache=ParsedReplayCache(user_replays, ErrorModel.version),
+                processes=parse_processes,
+                progress=lambda done: progress.update(
+                    'load',
+                    done,
+                    len(to_load),
+                ),
+                timings=progress.timings,
+            )
+        for digest, replay in loaded:
+            manifest.set_beatmap_id(digest, replay.beatmap.beatmap_id)
+
+    if warm_start:
+        model = ErrorModel.load_path(user_models)
+        incremental_runs = state.incremental_runs + 1
+    else:
+        model = ErrorModel()
+        incremental_runs = 0
+
+    if loaded or not warm_start:
+        # feature extraction happens inside ``fit``
+        with progress.stage('fit'):
+            model.fit([replay for _, replay in loaded])
+
+    with progress.stage('save'):
+        user_models.mkdir(parents=True, exist_ok=True)
+        model.save_path(user_models)
+        try:
+            export_model(model, model_cache_dir, user)
+        except Exception:
+            # the artifact only speeds up loading; the saved model is used
+            # without it
+            log.exception('failed to export the model artifact')
+
+    # write the state last so that a failed save is retrained
+    TrainingState(
+        fingerprint=fingerprint,
+        digests=frozenset(digests),
+        incremental_runs=incremental_runs,
+    ).write(model_cache_dir, user)
+
+    log.info(
+        'stage timings: {timings}',
+        timings=', '.join(
+            f'{stage}={duration:.2f}s'
+            for stage, duration in progress.timings.items()
+        ),
+    )
 
 
 if __name__ == '__main__':
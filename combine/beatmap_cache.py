@@ -0,0 +1,119 @@
+import threading
+
+import numpy as np
+
+from .utils import LRUCache
+
+
+# the accuracies to report the pp for: 95-100%
+pp_curve_accuracies = np.array([0.95, 0.96, 0.97, 0.98, 0.99, 1.00])
+
+# the mods which may change the pp of a play; every subset of these is one of
+# the 16 mod combinations the pp curves are cached for
+curve_mods = ('hard_rock', 'double_time', 'half_time', 'hidden')
+
+
+class CachedBeatmap:
+    """A parsed beatmap along with the pp curves for each combination of mods.
+
+    Parameters
+    ----------
+    beatmap : slider.Beatmap
+        The parsed beatmap.
+
+    Notes
+    -----
+    The pp curves are computed the first time they are requested for a given
+    mod combination and then held for the lifetime of the entry. Computing all
+    16 curves up front would make the first lookup of a map 16 times slower
+    when most callers only need the no-mod curve.
+    """
+    def __init__(self, beatmap):
+        self.beatmap = beatmap
+        self._pp_curves = {}
+        self._lock = threading.Lock()
+
+    def pp_curve(self, **mods):
+        """The pp earned for 95-100% accuracy with the given mods.
+
+        Parameters
+        ----------
+        **mods
+            The mods to apply. Only the mods in ``curve_mods`` are accepted.
+
+        Returns
+        -------
+        pp_curve : np.ndarray[float]
+            The pp for each accuracy in ``pp_curve_accuracies``.
+        """
+        unknown = mods.keys() - set(curve_mods)
+        if unknown:
+            raise TypeError(f'unknown mods: {sorted(unknown)}')
+
+        key = frozenset(k for k, v in mods.items() if v)
+        try:
+            return self._pp_curves[key]
+        except KeyError:
+            pass
+
+        with self._lock:
+            try:
+                return self._pp_curves[key]
+            except KeyError:
+                pp_curve = self._pp_curves[key] = (
+                    self.beatmap.performance_points(
+                        accuracy=pp_curve_accuracies,
+                        **{k: True for k in key},
+                    )
+                )
+                return pp_curve
+
+
+class BeatmapCache:
+    """A bounded cache of parsed beatmaps and their pp curves keyed by
+    beatmap id.
+
+    Parameters
+    ----------
+    load_beatmap : callable[int, slider.Beatmap]
+        The function used to load a beatmap on a cache miss. This should raise
+        a ``KeyError`` if the beatmap does not exist.
+    maxsize : int or None
+        The number of beatmaps to hold in memory at once. None will hold all
+        beatmaps in memory.
+    """
+    def __init__(self, load_beatmap, maxsize):
+        self._load_beatmap = load_beatmap
+        self._entries = LRUCache(maxsize)
+
+    def __getitem__(self, beatmap_id):
+        """Lookup a beatmap by id, loading it on a cache miss.
+
+        Parameters
+        ----------
+        beatmap_id : int
+            The id of the beatmap to look up.
+
+        Returns
+        -------
+        cached : CachedBeatmap
+            The parsed beatmap and its pp curves.
+
+        Raises
+        ------
+        KeyError
+            Raised when the beatmap cannot be found.
+        """
+        beatmap_id = int(beatmap_id)
+        try:
+            return self._entries[beatmap_id]
+        except KeyError:
+            pass
+
+        cached = self._entries[beatmap_id] = CachedBeatmap(
+            self._load_beatmap(beatmap_id),
+        )
+        return cached
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,10 +1,19 @@
 from functools import partial
+import os
 import pathlib
 
 import slider as sl
-from straitlets import StrictSerializable, Unicode, Instance, Integer, Enum
+from straitlets import (
+    Bool,
+    Enum,
+    Instance,
+    Integer,
+    StrictSerializable,
+    Unicode,
+)
 from straitlets.py3 import Path
 
+from .limits import JobLimits, parse_cpu_list
 from .train import TrainQueue
 
 
@@ -14,11 +23,39 @@ class Config(StrictSerializable):
     maps = Path(example='data/maps')
     models = Path(example='data/models')
     replays = Path(example='data/replays')
+    max_replay_size = Integer(default_value=16777216, example=16777216)
     train_queue_db = Path(example='data/train-queue.db')
+    train_workers = Integer(default_value=1, example=1)
+    train_job_timeout = Integer(
+        default_value=None,
+        allow_none=True,
+        example=None,
+    )
+    train_job_max_rss = Integer(
+        default_value=None,
+        allow_none=True,
+        example=None,
+    )
+    train_job_nice = Integer(default_value=0, example=0)
+    train_job_cpus = Unicode(default_value=None, allow_none=True, example=None)
+    max_train_jobs_per_user = Integer(default_value=1, example=1)
+    preload_train_worker = Bool(default_value=False, example=False)
+    replay_parse_processes = Integer(default_value=1, example=1)
+    gc_interval_hours = Integer(
+        default_value=None,
+        allow_none=True,
+        example=None,
+    )
 
     model_cache_size = Integer(example=24)
+    beatmap_cache_size = Integer(default_value=512, example=512)
+    predict_batch_max_size = Integer(default_value=100, example=100)
+    prediction_cache_size = Integer(default_value=4096, example=4096)
     token_secret_path = Path(example='data/token-secret')
+    token_cache_size = Integer(default_value=1024, example=1024)
     api_key = Unicode(example='<api-key>')
+    api_requests_per_minute = Integer(default_value=60, example=60)
+    beatmap_prefetch_workers = Integer(default_value=4, example=4)
     username = Unicode(example='<username>')
     password = Unicode(example='<password>')
     github_url = Unicode(example='http://github.com/example-user/example-repo')
@@ -60,6 +97,25 @@ class Config(StrictSerializable):
     def train_queue(self):
         return TrainQueue(self.train_queue_db)
 
+    @property
+    def train_job_limits(self):
+        cpus = self.train_job_cpus
+        if cpus is not None:
+            cpus = parse_cpu_list(cpus)
+            unavailable = cpus - os.sched_getaffinity(0)
+            if unavailable:
+                raise ValueError(
+                    'train_job_cpus includes cpus this process may not run'
+                    f' on: {sorted(unavailable)}',
+                )
+
+        return JobLimits(
+            timeout=self.train_job_timeout,
+            max_rss=self.train_job_max_rss,
+            nice=self.train_job_nice,
+            cpus=cpus,
+        )
+
     @property
     def client(self):
         return sl.Client(sl.Library(self.maps), self.api_key)
@@ -4,7 +4,9 @@ from itertools import combinations, chain
 import pathlib
 import random
 import re
+import socket
 import threading
+import time
 
 from cryptography.fernet import Fernet
 from lain import ErrorModel
@@ -12,10 +14,13 @@ import numpy as np
 from slider import GameMode, Mod
 from slider.client import ApprovedState
 
+from .beatmap_cache import BeatmapCache
 from .expiring_cache import ExpiringCache
 from .format_result import format_result
 from .logging import log, log_duration
+from .model_artifact import load_model as load_model_artifact
 from .token import gen_token
+from .train import Status
 from .utils import LockedIterator, model_path
 
 
@@ -48,7 +53,14 @@ class _periodic_task:
         underlying_function = self._function
 
         def wrapped_function(*args, **kwargs):
-            underlying_function(*args, **kwargs)
+            try:
+                underlying_function(*args, **kwargs)
+            except Exception:
+                # keep the task scheduled after a transient failure
+                log.exception(
+                    'periodic task {name} failed',
+                    name=underlying_function.__name__,
+                )
             start()
 
         def start():
@@ -170,7 +182,7 @@ class Handler:
 
 def powerset(values):
     return chain.from_iterable(
-        combinations(values, n) for n in range(len(values) + 1),
+        combinations(values, n) for n in range(len(values) + 1)
     )
 
 
@@ -188,6 +200,9 @@ class CombineHandler(Handler):
     model_cache_size : int or None
         The number of models to hold in memory at once. None will hold all
         models in memory.
+    beatmap_cache_size : int or None
+        The number of parsed beatmaps and pp curves to hold in memory at once.
+        None will hold all beatmaps in memory.
     token_secret : bytes
         The secret key for generating tokens.
     upload_url : str
@@ -198,13 +213,17 @@ class CombineHandler(Handler):
     # the weights for the top 100 scores
     _pp_weights = 0.95 ** np.arange(100)
     _user_stats_cache_lifetime = datetime.timedelta(hours=2)
-    _pp_curve_accuracies = np.array([0.95, 0.96, 0.97, 0.98, 0.99, 1.00])
+    _train_queue_retention = datetime.timedelta(days=30)
+    # how often to check for completed jobs if the trainer's notification
+    # was lost
+    _training_status_fallback = datetime.timedelta(minutes=5)
 
     def __init__(self,
                  bot_user,
                  osu_client,
                  model_cache_dir,
                  model_cache_size,
+                 beatmap_cache_size,
                  token_secret,
                  upload_url,
                  train_queue):
@@ -216,8 +235,16 @@ class CombineHandler(Handler):
         self.token_secret = Fernet(token_secret)
         self.upload_url = upload_url
         self.train_queue = train_queue
+        # the periodic tasks run in a new thread each time, so share one
+        # connection between them; each task only runs once at a time
+        self._report_queue = None
+        self._completed_jobs = None
 
         self.get_model = lru_cache(model_cache_size)(self._get_model)
+        self.beatmap_cache = BeatmapCache(
+            self._load_beatmap,
+            beatmap_cache_size,
+        )
         self._user_stats = ExpiringCache()
 
         self._candidates = LockedIterator(self._gen_candidates())
@@ -235,24 +262,63 @@ class CombineHandler(Handler):
 
         return osu_client
 
-    @periodic_task(datetime.timedelta(seconds=30))
+    @periodic_task(datetime.timedelta(0))
     def report_training_status(self, client):
-        """Every 30 seconds, check the database to see if we have any new
-        results to report and send them to users.
+        """Send new training results to users, then wait until the trainer
+        says that another job has completed.
         """
-        for user, status in self.train_queue.copy().get_completed_jobs():
-            self.send(
-                client,
-                user,
-                f'model training complete: {status.value}',
+        fallback = self._training_status_fallback.total_seconds()
+        if self._report_queue is None:
+            self._report_queue = self.train_queue.copy(check_same_thread=False)
+            self._completed_jobs = completed_jobs = (
+                self._report_queue.listen_for_completed_jobs()
             )
+            completed_jobs.settimeout(fallback)
+
+        try:
+            for user, status in self._report_queue.get_completed_jobs():
+                self.send(
+                    client,
+                    user,
+                    f'model training complete: {status.value}',
+                )
+
+            self._completed_jobs.recv(1)
+        except socket.timeout:
+            pass
+        except Exception:
+            log.exception('failed to report training status')
+            # reconnect on the next run, and don't spin while the error
+            # persists
+            self.train_queue.close_listener(self._completed_jobs)
+            self._report_queue = self._completed_jobs = None
+            time.sleep(fallback)
+
+    @periodic_task(datetime.timedelta(hours=1))
+    def prune_train_queue(self, client):
+        """Every hour, delete old jobs which have already been reported so
+        that the queue does not grow for ever.
+        """
+        pruned = self.train_queue.copy().prune(self._train_queue_retention)
+        if pruned:
+            log.info('pruned {pruned} old train jobs', pruned=pruned)
 
     def _get_model(self, user):
+        model = load_model_artifact(self.model_cache_dir, user)
+        if model is not None:
+            return model
         try:
             return ErrorModel.load_path(model_path(self.model_cache_dir, user))
         except FileNotFoundError:
             raise KeyError(user)
 
+    def _load_beatmap(self, beatmap_id):
+        return self.osu_client.library.lookup_by_id(
+            beatmap_id,
+            download=True,
+            save=True,
+        )
+
     def _gen_candidates(self):
         candidates = []
         while True:
@@ -449,6 +515,43 @@ class CombineHandler(Handler):
             ' osu!/Chat directory and open the newest file.'
         )
 
+    _stage_descriptions = {
+        'sync': 'indexing replays',
+        'load': 'loading replays',
+        'fit': 'fitting the model',
+        'save': 'saving the model',
+    }
+
+    @command('!status')
+    def status(self, client, user, msg):
+        """Show the progress of the user's most recent train job.
+        """
+        if msg:
+            raise CommandFailure(f'status takes no arguments, got: {msg!r}')
+
+        try:
+            status, progress, _ = self.train_queue.copy().get_progress(user)
+        except KeyError:
+            raise CommandFailure(
+                self._no_model_message.format(user=user, url=self.upload_url)
+            )
+
+        if status == Status.not_started:
+            message = 'your model is waiting to be trained'
+        elif status == Status.running:
+            message = 'your model is training'
+            if progress is not None:
+                stage = progress['stage']
+                message += (
+                    ': ' + self._stage_descriptions.get(stage, stage)
+                )
+                if 'total' in progress:
+                    message += f' ({progress["done"]}/{progress["total"]})'
+        else:
+            message = f'model training complete: {status.value}'
+
+        self.send(client, user, message)
+
     _np_pattern = re.compile(
         r'is listening to \[https://osu.ppy.sh/b/(\d+)',
     )
@@ -459,13 +562,9 @@ class CombineHandler(Handler):
         if match is None:
             return
 
-        beatmap = self.osu_client.beatmap(
-            beatmap_id=match.groups(1),
-        ).beatmap(save=True)
-
-        pp_curve = beatmap.performance_points(
-            accuracy=self._pp_curve_accuracies,
-        )
+        cached = self.beatmap_cache[match.group(1)]
+        beatmap = cached.beatmap
+        pp_curve = cached.pp_curve()
 
         try:
             model = self.get_model(user)
@@ -0,0 +1,286 @@
+"""Resource limits and usage accounting for train jobs.
+"""
+from collections import namedtuple
+import os
+import signal
+import time
+
+
+class JobLimits(namedtuple('JobLimits', 'timeout max_rss nice cpus')):
+    """The resources a train job may use.
+
+    Parameters
+    ----------
+    timeout : float or None
+        The number of seconds a job may run for.
+    max_rss : int or None
+        The maximum resident set size of a job in bytes.
+    nice : int
+        The niceness to add to a job's process.
+    cpus : set[int] or None
+        The cpus a job may run on.
+    """
+    @classmethod
+    def unlimited(cls):
+        """Limits which do not restrict the job.
+        """
+        return cls(timeout=None, max_rss=None, nice=0, cpus=None)
+
+
+def parse_cpu_list(cpus):
+    """Parse a cpu list like ``'0-3,6'``.
+
+    Parameters
+    ----------
+    cpus : str
+        The comma separated cpus or ranges of cpus.
+
+    Returns
+    -------
+    cpus : set[int]
+        The cpus in the list.
+
+    Raises
+    ------
+    ValueError
+        Raised when the list is malformed.
+    """
+    out = set()
+    for part in cpus.split(','):
+        start, sep, stop = part.strip().partition('-')
+        if sep:
+            out.update(range(int(start), int(stop) + 1))
+        else:
+            out.add(int(start))
+    return out
+
+
+class JobUsage(namedtuple('JobUsage', 'peak_rss cpu_time')):
+    """The resources a train job used.
+
+    Parameters
+    ----------
+    peak_rss : int or None
+        The peak resident set size of the job in bytes.
+    cpu_time : float or None
+        The user and system cpu time of the job in seconds.
+    """
+
+
+def apply_limits(pid, limits):
+    """Apply the niceness and cpu affinity of ``limits`` to a process.
+
+    Parameters
+    ----------
+    pid : int
+        The process to limit, or 0 for the calling process.
+    limits : JobLimits
+        The limits to apply.
+    """
+    if limits.nice:
+        os.setpriority(
+            os.PRIO_PROCESS,
+            pid,
+            os.getpriority(os.PRIO_PROCESS, pid) + limits.nice,
+        )
+    if limits.cpus is not None:
+        os.sched_setaffinity(pid, limits.cpus)
+
+
+def _read_stat(pid):
+    """Read the fields of ``/proc/<pid>/stat`` after the command.
+    """
+    with open(f'/proc/{pid}/stat') as f:
+        stat = f.read()
+    # skip the pid and the command, which may contain spaces
+    return stat[stat.rindex(')') + 2:].split()
+
+
+def _read_proc_usage(pid):
+    """Read the current rss, peak rss, and cpu time of a process from
+    ``/proc``.
+
+    The cpu time includes the children the process has waited for.
+    """
+    rss = peak_rss = None
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith('VmHWM:'):
+                peak_rss = int(line.split()[1]) * 1024
+
+    fields = _read_stat(pid)
+    # utime, stime, cutime, cstime
+    ticks = sum(int(field) for field in fields[11:15])
+    cpu_time = ticks / os.sysconf('SC_CLK_TCK')
+    return rss or 0, JobUsage(peak_rss=peak_rss, cpu_time=cpu_time)
+
+
+def _session_pids(sid):
+    """Find the processes in a session other than its leader.
+    """
+    pids = []
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit() or int(entry.name) == sid:
+            continue
+        try:
+            # the fields start with the state, ppid, pgrp, and session
+            if int(_read_stat(entry.name)[3]) == sid:
+                pids.append(int(entry.name))
+        except (FileNotFoundError, ProcessLookupError, IndexError):
+            # the process exited while we were reading it
+            pass
+    return pids
+
+
+def _read_tree_usage(pid):
+    """Read the current rss and usage of a process and the processes it
+    started, like the replay parsing pool.
+
+    The process must lead its own session.
+    """
+    rss, usage = _read_proc_usage(pid)
+    cpu_time = usage.cpu_time
+    for child in _session_pids(pid):
+        try:
+            child_rss, child_usage = _read_proc_usage(child)
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        rss += child_rss
+        cpu_time += child_usage.cpu_time
+
+    return rss, JobUsage(
+        peak_rss=max(rss, usage.peak_rss or 0),
+        cpu_time=cpu_time,
+    )
+
+
+def kill_tree(pid):
+    """Kill a process which leads its own session and everything it
+    started.
+
+    Parameters
+    ----------
+    pid : int
+        The process to kill.
+    """
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # the process has not made its own session yet, or it has exited
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def monitor(pid, wait, limits, interval=1):
+    """Wait for a process to exit, killing it if it exceeds its limits.
+
+    Parameters
+    ----------
+    pid : int
+        The process to monitor. The process must lead its own session; the
+        memory used by every process in the session counts against the
+        limits, and they are all killed when a limit is exceeded.
+    wait : callable[float, int or None]
+        A function which waits up to the given number of seconds for the
+        process to exit and returns its exit code, or None if it is still
+        running.
+    limits : JobLimits
+        The limits to enforce.
+    interval : float, optional
+        The number of seconds between checks.
+
+    Returns
+    -------
+    returncode : int
+        The process' exit code.
+    reason : str or None
+        Why the process was killed, or None if it exited on its own.
+    usage : JobUsage
+        The resources the process and the processes it started used as of
+        the last check.
+    """
+    start = time.monotonic()
+    reason = None
+    usage = JobUsage(peak_rss=None, cpu_time=None)
+    while True:
+        returncode = wait(interval)
+        if returncode is not None:
+            # Kill the processes the job left behind, like the parsing pool
+            # of a job which crashed. The pid cannot be reused while its
+            # session has members.
+            if _session_pids(pid):
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            return returncode, reason, usage
+
+        if reason is not None:
+            # already killed, wait for the process to exit
+            continue
+
+        try:
+            rss, current = _read_tree_usage(pid)
+        except (FileNotFoundError, ProcessLookupError):
+            # the process exited between the wait and the read
+            continue
+        usage = JobUsage(
+            peak_rss=max(current.peak_rss, usage.peak_rss or 0),
+            cpu_time=current.cpu_time,
+        )
+
+        elapsed = time.monotonic() - start
+        if limits.timeout is not None and elapsed > limits.timeout:
+            reason = f'timed out after {limits.timeout} seconds'
+        elif limits.max_rss is not None and rss > limits.max_rss:
+            reason = f'exceeded the memory limit of {limits.max_rss} bytes'
+        else:
+            continue
+
+        kill_tree(pid)
+
+
+def _exit_code(status):
+    """Convert a wait status into an exit code like
+    ``subprocess.Popen.returncode``.
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait4(pid, timeout, poll_interval=0.05):
+    """Wait for a child process to exit and collect its resource usage.
+
+    Parameters
+    ----------
+    pid : int
+        The child process to wait for.
+    timeout : float
+        The maximum number of seconds to wait.
+    poll_interval : float, optional
+        The number of seconds between checks.
+
+    Returns
+    -------
+    result : (int, JobUsage) or None
+        The exit code and resource usage of the process, or None if it is
+        still running.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        waited, status, rusage = os.wait4(pid, os.WNOHANG)
+        if waited:
+            return _exit_code(status), JobUsage(
+                peak_rss=rusage.ru_maxrss * 1024,
+                cpu_time=rusage.ru_utime + rusage.ru_stime,
+            )
+
+        if time.monotonic() >= deadline:
+            return None
+
+        time.sleep(poll_interval)
@@ -0,0 +1,584 @@
+"""Header-only replay reading and the per-user replay manifest.
+
+The manifest records the header of every replay a user has uploaded so that
+later stages can select replays without opening and parsing the ``.osr``
+files.
+"""
+from collections import namedtuple
+import datetime
+import hashlib
+import os
+import pathlib
+import sqlite3
+import time
+
+from slider import GameMode
+from slider.mod import Mod
+
+from .logging import log
+
+
+class InvalidReplay(Exception):
+    """Raised when a replay is corrupt or would be discarded by training.
+    """
+
+
+class ReplayHeader(namedtuple('ReplayHeader', (
+        'mode',
+        'version',
+        'beatmap_md5',
+        'player_name',
+        'replay_md5',
+        'mods',
+        'timestamp',
+        'failed',
+))):
+    """The metadata stored at the start of an ``.osr`` file.
+
+    Parameters
+    ----------
+    mode : GameMode
+        The game mode the replay was played in.
+    version : int
+        The version of osu! which created the replay.
+    beatmap_md5 : str
+        The md5 hash of the beatmap that was played.
+    player_name : str
+        The name of the player.
+    replay_md5 : str
+        The md5 hash of the replay.
+    mods : int
+        The mod mask used in the play.
+    timestamp : float
+        When the replay was played as a unix timestamp.
+    failed : bool
+        Did the player's life bar reach zero?
+    """
+
+
+# the number of windows ticks (100ns) between 0001-01-01 and the unix epoch
+_windows_ticks_to_unix_epoch = 621355968000000000
+
+
+def _read(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise InvalidReplay('unexpected end of file')
+    return data
+
+
+def _read_int(file, size):
+    return int.from_bytes(_read(file, size), 'little')
+
+
+def _read_uleb128(file):
+    result = 0
+    shift = 0
+    while True:
+        byte = _read(file, 1)[0]
+        result |= (byte & 0x7f) << shift
+        if (byte & 0x80) == 0:
+            return result
+        shift += 7
+
+
+def _read_string(file):
+    mode = _read(file, 1)[0]
+    if mode == 0:
+        return None
+    if mode != 0x0b:
+        raise InvalidReplay(
+            f'unknown string start byte: {hex(mode)}, expected 0 or 0x0b',
+        )
+
+    try:
+        return _read(file, _read_uleb128(file)).decode('utf-8')
+    except UnicodeDecodeError as e:
+        raise InvalidReplay(f'invalid string: {e}')
+
+
+def _parse_failed(life_bar_graph):
+    """Check whether a life bar graph ever reaches zero.
+
+    The graph is a comma separated list of ``offset|life`` pairs.
+    """
+    if not life_bar_graph:
+        return False
+
+    for pair in life_bar_graph.split(','):
+        if not pair:
+            continue
+        try:
+            _, life = pair.split('|')
+            if not float(life):
+                return True
+        except ValueError:
+            raise InvalidReplay(f'invalid life bar graph entry: {pair!r}')
+    return False
+
+
+def read_replay_header(file):
+    """Read the header of an ``.osr`` file without reading the replay data.
+
+    Parameters
+    ----------
+    file : file-like
+        The file to read from, positioned at the start of the replay.
+
+    Returns
+    -------
+    header : ReplayHeader
+        The replay's header.
+
+    Raises
+    ------
+    InvalidReplay
+        Raised when the header cannot be parsed.
+    """
+    try:
+        mode = GameMode(_read_int(file, 1))
+    except ValueError as e:
+        raise InvalidReplay(str(e))
+
+    version = _read_int(file, 4)
+    beatmap_md5 = _read_string(file)
+    player_name = _read_string(file)
+    replay_md5 = _read_string(file)
+    # count_300, count_100, count_50, count_geki, count_katu, count_miss,
+    # score, max_combo, full_combo
+    _read(file, 2 * 6 + 4 + 2 + 1)
+    mods = _read_int(file, 4)
+    failed = _parse_failed(_read_string(file))
+    ticks = _read_int(file, 8)
+
+    if beatmap_md5 is None:
+        raise InvalidReplay('missing beatmap md5')
+
+    return ReplayHeader(
+        mode=mode,
+        version=version,
+        beatmap_md5=beatmap_md5,
+        player_name=player_name,
+        replay_md5=replay_md5,
+        mods=mods,
+        timestamp=(ticks - _windows_ticks_to_unix_epoch) / 10 ** 7,
+        failed=failed,
+    )
+
+
+# mods which are not representative of the user's skill; training ignores
+# plays which use any of these
+_ignored_mods = (
+    Mod.autoplay |
+    Mod.spun_out |
+    Mod.auto_pilot |
+    Mod.cinema |
+    Mod.relax
+)
+
+
+def validate_replay_header(header):
+    """Check that a replay would be used when training.
+
+    Parameters
+    ----------
+    header : ReplayHeader
+        The header of the replay.
+
+    Raises
+    ------
+    InvalidReplay
+        Raised when the replay would be discarded by training.
+    """
+    if header.mode != GameMode.standard:
+        raise InvalidReplay(f'unsupported game mode: {header.mode.name}')
+
+    if header.mods & _ignored_mods:
+        raise InvalidReplay('replay uses unranked mods')
+
+    if header.failed:
+        raise InvalidReplay('replay is a failed play')
+
+
+def manifest_path(user_replays):
+    """Return the path to a user's replay manifest.
+
+    Parameters
+    ----------
+    user_replays : path-like
+        The user's replay directory.
+
+    Returns
+    -------
+    path : pathlib.Path
+        The path to the manifest database.
+    """
+    return pathlib.Path(user_replays) / '.manifest.db'
+
+
+def rejected_path(user_replays):
+    """Return the directory which unusable replays are moved into.
+
+    Parameters
+    ----------
+    user_replays : path-like
+        The user's replay directory.
+
+    Returns
+    -------
+    path : pathlib.Path
+        The path to the rejected replay directory.
+    """
+    return pathlib.Path(user_replays) / '.rejected'
+
+
+class ReplayManifest:
+    """The headers of every replay stored for a user.
+
+    Parameters
+    ----------
+    user_replays : path-like
+        The user's replay directory.
+    """
+    def __init__(self, user_replays):
+        self._user_replays = pathlib.Path(user_replays)
+        self._db = db = sqlite3.connect(
+            os.fspath(manifest_path(user_replays)),
+            timeout=60,
+        )
+        # let train jobs read and sync the manifest while replays are being
+        # uploaded
+        db.execute('pragma journal_mode=wal')
+        db.execute(
+            """
+            create table if not exists replays (
+                digest text primary key,
+                beatmap_md5 text not null,
+                player_name text,
+                mode int not null,
+                mods int not null,
+                timestamp real not null,
+                beatmap_id int,
+                failed int
+            )
+            """,
+        )
+        columns = {row[1] for row in db.execute('pragma table_info(replays)')}
+        if 'beatmap_id' not in columns:
+            # manifests written before the beatmap id was recorded
+            db.execute('alter table replays add column beatmap_id int')
+        if 'failed' not in columns:
+            # manifests written before failed plays were rejected; ``sync``
+            # checks these rows again
+            db.execute('alter table replays add column failed int')
+        db.execute(
+            'create index if not exists replays_timestamp'
+            ' on replays (timestamp)',
+        )
+        # the longest age the user has trained with, in seconds; null means
+        # the user has trained on all of their replays
+        db.execute(
+            'create table if not exists training_age (seconds real)',
+        )
+        db.commit()
+
+    def commit(self):
+        """Commit the replays added since the last commit.
+        """
+        self._db.commit()
+
+    def close(self):
+        """Commit any pending changes and close the underlying database
+        connection.
+        """
+        self._db.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, digest, header):
+        """Record a replay in the manifest.
+
+        Parameters
+        ----------
+        digest : str
+            The hex sha256 digest of the replay file.
+        header : ReplayHeader
+            The replay's header.
+
+        Notes
+        -----
+        The change is not written until ``commit`` or ``close`` is called.
+        """
+        self._db.execute(
+            """
+            insert or ignore into replays (
+                digest,
+                beatmap_md5,
+                player_name,
+                mode,
+                mods,
+                timestamp,
+                failed
+            ) values (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                digest,
+                header.beatmap_md5,
+                header.player_name,
+                header.mode.value,
+                header.mods,
+                header.timestamp,
+                header.failed,
+            ),
+        )
+
+    def set_beatmap_id(self, digest, beatmap_id):
+        """Record the id of the beatmap a replay was played on.
+
+        Parameters
+        ----------
+        digest : str
+            The hex sha256 digest of the replay file.
+        beatmap_id : int
+            The id of the beatmap.
+
+        Notes
+        -----
+        The change is not written until ``commit`` or ``close`` is called.
+        """
+        self._db.execute(
+            'update replays set beatmap_id=? where digest=?',
+            (beatmap_id, digest),
+        )
+
+    def sync(self):
+        """Add any replays in the user's directory which are missing from the
+        manifest.
+
+        Replays uploaded before the manifest existed are stored under their
+        original file names; these are renamed to their content address.
+        Duplicate replays are removed and unusable replays are moved into
+        the user's ``.rejected`` directory. Replays which were recorded before
+        failed plays were rejected are checked again.
+
+        Returns
+        -------
+        added : int
+            The number of replays added to the manifest.
+        """
+        # import here to avoid a cycle
+        from .replay_store import replay_path
+
+        self._reject_unchecked_failed_plays()
+
+        known = {
+            digest for digest, in self._db.execute('select digest from replays')
+        }
+        added = 0
+        for entry in os.scandir(self._user_replays):
+            name = entry.name
+            if (not name.lower().endswith('.osr') or
+                    name[:-len('.osr')] in known):
+                continue
+
+            sha256 = hashlib.sha256()
+            try:
+                with open(entry.path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(64 * 1024), b''):
+                        sha256.update(chunk)
+                    f.seek(0)
+                    header = read_replay_header(f)
+                validate_replay_header(header)
+            except InvalidReplay as e:
+                self._reject(entry.path, e)
+                continue
+
+            digest = sha256.hexdigest()
+            if digest in known:
+                # duplicate of an existing replay
+                os.unlink(entry.path)
+                continue
+
+            path = replay_path(self._user_replays, digest)
+            if entry.path != os.fspath(path):
+                os.rename(entry.path, path)
+
+            self.add(digest, header)
+            known.add(digest)
+            added += 1
+
+        self.commit()
+        return added
+
+    def _reject(self, path, reason):
+        """Move an unusable replay out of the user's replay directory.
+        """
+        log.info(
+            'rejecting unusable replay {path}: {reason}',
+            path=path,
+            reason=reason,
+        )
+        rejected = rejected_path(self._user_replays)
+        rejected.mkdir(exist_ok=True)
+        os.rename(path, rejected / os.path.basename(path))
+
+    def _reject_unchecked_failed_plays(self):
+        """Check the replays recorded before failed plays were rejected.
+        """
+        # import here to avoid a cycle
+        from .replay_store import replay_path
+
+        unchecked = [
+            digest for digest, in self._db.execute(
+                'select digest from replays where failed is null',
+            )
+        ]
+        for digest in unchecked:
+            path = replay_path(self._user_replays, digest)
+            try:
+                with open(path, 'rb') as f:
+                    failed = read_replay_header(f).failed
+            except FileNotFoundError:
+                self.remove(digest)
+                continue
+            except InvalidReplay as e:
+                self.remove(digest)
+                self._reject(path, e)
+                continue
+
+            if failed:
+                self.remove(digest)
+                self._reject(path, 'replay is a failed play')
+            else:
+                self._db.execute(
+                    'update replays set failed=0 where digest=?',
+                    (digest,),
+                )
+
+    def select(self, age=None):
+        """Select the replays to train on.
+
+        Parameters
+        ----------
+        age : datetime.timedelta, optional
+            Only select replays less than this age old.
+
+        Returns
+        -------
+        digests : list[str]
+            The digests of the selected replays.
+        """
+        if age is None:
+            since = float('-inf')
+        else:
+            since = time.time() - age.total_seconds()
+
+        return [
+            digest for digest, in self._db.execute(
+                'select digest from replays where timestamp >= ?'
+                ' order by timestamp',
+                (since,),
+            )
+        ]
+
+    def select_older(self, age):
+        """Select the replays which are too old to be trained on.
+
+        Parameters
+        ----------
+        age : datetime.timedelta
+            Select replays at least this age old.
+
+        Returns
+        -------
+        digests : list[str]
+            The digests of the selected replays.
+        """
+        since = time.time() - age.total_seconds()
+        return [
+            digest for digest, in self._db.execute(
+                'select digest from replays where timestamp < ?'
+                ' order by timestamp',
+                (since,),
+            )
+        ]
+
+    def remove(self, digest):
+        """Remove a replay from the manifest.
+
+        Parameters
+        ----------
+        digest : str
+            The hex sha256 digest of the replay.
+
+        Notes
+        -----
+        The replay file itself is not removed. The change is not written
+        until ``commit`` or ``close`` is called.
+        """
+        self._db.execute('delete from replays where digest=?', (digest,))
+
+    def record_training_age(self, age):
+        """Record the age of the replays a train job is using.
+
+        Parameters
+        ----------
+        age : datetime.timedelta or None
+            The age of the replays being trained on, or None if all of the
+            replays are being trained on.
+
+        Notes
+        -----
+        Only the longest age is kept so that replays which any job may still
+        train on are never archived. The change is written immediately.
+        """
+        seconds = age.total_seconds() if age is not None else None
+        db = self._db
+        with db:
+            rows = list(db.execute('select seconds from training_age'))
+            if not rows:
+                db.execute(
+                    'insert into training_age (seconds) values (?)',
+                    (seconds,),
+                )
+            elif rows[0][0] is not None and (seconds is None or
+                                             seconds > rows[0][0]):
+                db.execute('update training_age set seconds=?', (seconds,))
+
+    def longest_training_age(self):
+        """Look up the longest age the user has trained with.
+
+        Returns
+        -------
+        age : datetime.timedelta or None
+            The longest age, or None if the user has trained on all of their
+            replays.
+
+        Raises
+        ------
+        KeyError
+            Raised when no age has been recorded for the user.
+        """
+        rows = list(self._db.execute('select seconds from training_age'))
+        if not rows:
+            raise KeyError(self._user_replays.name)
+
+        seconds, = rows[0]
+        if seconds is None:
+            return None
+        return datetime.timedelta(seconds=seconds)
+
+    def __contains__(self, digest):
+        return bool(list(self._db.execute(
+            'select 1 from replays where digest=?',
+            (digest,),
+        )))
+
+    def __len__(self):
+        (count,), = self._db.execute('select count(*) from replays')
+        return count
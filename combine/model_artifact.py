@@ -0,0 +1,190 @@
+"""An inference-only copy of a user's model which loads without
+deserializing the full model.
+
+The weights are stored as one flat ``.npy`` array which is memory-mapped on
+load, so the pages are only read when the model is used. The rest of the
+model's state is stored in a small pickle next to it along with the
+``model_version`` of the model it was exported from. An artifact which does
+not match the current model is ignored and the model is read with
+``ErrorModel.load_path`` instead.
+"""
+import os
+import pickle
+
+from lain import ErrorModel
+import numpy as np
+
+from .logging import log
+from .utils import model_path, model_version
+
+
+# bump this when the layout of the artifact changes
+_artifact_version = 1
+
+
+def artifact_paths(root, user):
+    """Return the paths to a user's model artifact.
+
+    Parameters
+    ----------
+    root : path-like
+        The root model directory.
+    user : str
+        The user to get the artifact paths for.
+
+    Returns
+    -------
+    weights_path : pathlib.Path
+        The path to the flat array of weights.
+    state_path : pathlib.Path
+        The path to the rest of the model's state.
+    """
+    path = model_path(root, user)
+    return (
+        path.with_name(f'{path.name}.artifact.npy'),
+        path.with_name(f'{path.name}.artifact.pickle'),
+    )
+
+
+def _keras_model(model):
+    """The keras model which holds an ``ErrorModel``'s weights, or None if
+    this version of lain does not store one.
+    """
+    inner = getattr(model, '_model', None)
+    if not (hasattr(inner, 'get_weights') and hasattr(inner, 'set_weights')):
+        return None
+    return inner
+
+
+def _replace(write, path):
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.rename(tmp_path, path)
+
+
+def export_model(model, root, user, dtype=None):
+    """Write the inference artifact for a user's model.
+
+    This must be called after the model is saved with ``save_path``.
+
+    Parameters
+    ----------
+    model : ErrorModel
+        The model which was just saved.
+    root : path-like
+        The root model directory.
+    user : str
+        The user the model belongs to.
+    dtype : np.dtype, optional
+        The dtype to store the weights as, for example ``np.float16`` to
+        halve the size of the artifact. Defaults to the dtype of the
+        weights.
+
+    Returns
+    -------
+    exported : bool
+        Was the artifact written? This is False when the model does not
+        expose its weights.
+    """
+    inner = _keras_model(model)
+    if inner is None:
+        return False
+
+    weights = inner.get_weights()
+    if dtype is None:
+        dtype = np.result_type(*weights) if weights else np.float32
+    flat = np.concatenate(
+        [np.ravel(w).astype(dtype) for w in weights]
+        if weights else
+        [np.empty(0, dtype=dtype)],
+    )
+
+    state = {
+        'artifact_version': _artifact_version,
+        'error_model_version': ErrorModel.version,
+        # ties the artifact to the model files written by ``save_path``
+        'model_version': model_version(root, user),
+        'shapes': [w.shape for w in weights],
+        'dtypes': [w.dtype.str for w in weights],
+        'attributes': {
+            name: value
+            for name, value in vars(model).items()
+            if value is not inner
+        },
+    }
+
+    weights_path, state_path = artifact_paths(root, user)
+    # remove the old state first so that it can never describe the new
+    # weights
+    try:
+        os.unlink(state_path)
+    except FileNotFoundError:
+        pass
+    _replace(lambda f: np.save(f, flat), weights_path)
+    _replace(lambda f: pickle.dump(state, f), state_path)
+    return True
+
+
+def load_model(root, user):
+    """Load a user's model from its inference artifact.
+
+    Parameters
+    ----------
+    root : path-like
+        The root model directory.
+    user : str
+        The user to load the model for.
+
+    Returns
+    -------
+    model : ErrorModel or None
+        The model, or None if there is no artifact for the current model.
+    """
+    weights_path, state_path = artifact_paths(root, user)
+    try:
+        with open(state_path, 'rb') as f:
+            state = pickle.load(f)
+        current = model_version(root, user)
+    except (FileNotFoundError, KeyError):
+        return None
+
+    if (state.get('artifact_version') != _artifact_version or
+            state.get('error_model_version') != ErrorModel.version or
+            state.get('model_version') != current):
+        # the model was retrained or lain was upgraded since the export
+        return None
+
+    try:
+        flat = np.load(weights_path, mmap_mode='r')
+    except FileNotFoundError:
+        return None
+
+    weights = []
+    offset = 0
+    for shape, dtype in zip(state['shapes'], state['dtypes']):
+        size = int(np.prod(shape))
+        weights.append(
+            flat[offset:offset + size].reshape(shape).astype(
+                dtype,
+                copy=False,
+            ),
+        )
+        offset += size
+    if offset != len(flat):
+        log.warning(
+            'ignoring the model artifact for {user}: expected {expected}'
+            ' weights but found {found}',
+            user=user,
+            expected=offset,
+            found=len(flat),
+        )
+        return None
+
+    model = ErrorModel()
+    inner = _keras_model(model)
+    if inner is None:
+        return None
+    vars(model).update(state['attributes'])
+    inner.set_weights(weights)
+    return model
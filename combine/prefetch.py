@@ -0,0 +1,115 @@
+"""Background downloading of the beatmaps referenced by uploaded replays.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from .logging import log
+
+
+class RateLimiter:
+    """A token bucket which limits how often an operation may happen across
+    threads.
+
+    Parameters
+    ----------
+    per_minute : float
+        The number of operations allowed per minute.
+    """
+    def __init__(self, per_minute):
+        self._interval = 60 / per_minute
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until another operation is allowed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self._interval
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class BeatmapPrefetcher:
+    """Download beatmaps into the library in background threads.
+
+    Parameters
+    ----------
+    client : slider.Client
+        The client to download beatmaps with.
+    workers : int
+        The number of concurrent downloads.
+    requests_per_minute : float
+        The maximum number of osu! API requests this prefetcher makes per
+        minute. The limit is per process.
+
+    Notes
+    -----
+    The worker threads are started on the first call to ``prefetch`` so that
+    the prefetcher may be built before gunicorn forks its workers.
+    """
+    def __init__(self, client, *, workers, requests_per_minute):
+        self._root_client = client
+        self._workers = workers
+        self._rate_limiter = RateLimiter(requests_per_minute)
+
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._tls = threading.local()
+
+    @property
+    def _client(self):
+        """A thread-local :class:`slider.Client`.
+        """
+        try:
+            client = self._tls.client
+        except AttributeError:
+            client = self._tls.client = self._root_client.copy()
+
+        return client
+
+    def prefetch(self, beatmap_md5s):
+        """Enqueue downloads for beatmaps which are not yet in the library.
+
+        Parameters
+        ----------
+        beatmap_md5s : iterable[str]
+            The md5 hashes of the beatmaps to download. Beatmaps which are
+            already being downloaded are skipped.
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self._workers)
+
+            for beatmap_md5 in beatmap_md5s:
+                if beatmap_md5 in self._pending:
+                    continue
+
+                self._pending.add(beatmap_md5)
+                self._executor.submit(self._fetch, beatmap_md5)
+
+    def _fetch(self, beatmap_md5):
+        try:
+            client = self._client
+            try:
+                client.library.lookup_by_md5(beatmap_md5)
+            except KeyError:
+                pass
+            else:
+                # already in the library
+                return
+
+            self._rate_limiter.acquire()
+            client.beatmap(beatmap_md5=beatmap_md5).beatmap(save=True)
+        except Exception:
+            log.exception(
+                'failed to prefetch beatmap {beatmap_md5}',
+                beatmap_md5=beatmap_md5,
+            )
+        finally:
+            with self._lock:
+                self._pending.discard(beatmap_md5)
@@ -0,0 +1,208 @@
+"""A per-user cache of parsed replays stored as numpy arrays.
+
+Parsing a replay means decompressing and decoding every cursor action, which
+dominates the cost of loading training data. The parsed replay is stored as
+a ``.npz`` of flat arrays keyed by the replay's content hash so that later
+training jobs can rebuild the :class:`slider.Replay` without parsing the
+``.osr`` file again.
+"""
+import datetime
+import os
+import pathlib
+import tempfile
+
+import numpy as np
+from slider import GameMode, Replay
+from slider.mod import Mod
+from slider.position import Position
+from slider.replay import Action
+
+
+_count_fields = (
+    'count_300',
+    'count_100',
+    'count_50',
+    'count_geki',
+    'count_katu',
+    'count_miss',
+)
+
+_action_dtype = np.dtype([
+    ('offset', 'f8'),
+    ('x', 'f8'),
+    ('y', 'f8'),
+    ('key1', '?'),
+    ('key2', '?'),
+    ('mouse1', '?'),
+    ('mouse2', '?'),
+])
+
+
+def _mod_mask(replay):
+    mask = 0
+    for name, mod in Mod.__members__.items():
+        if getattr(replay, name, False):
+            mask |= mod
+    return int(mask)
+
+
+def replay_to_arrays(replay):
+    """Convert a parsed replay into flat arrays.
+
+    Parameters
+    ----------
+    replay : slider.Replay
+        The replay to convert.
+
+    Returns
+    -------
+    arrays : dict[str, np.ndarray]
+        The replay data. The beatmap is not included.
+    """
+    actions = replay.actions
+    action_array = np.empty(len(actions), dtype=_action_dtype)
+    action_array['offset'] = [
+        action.offset.total_seconds() * 1000 for action in actions
+    ]
+    action_array['x'] = [action.position.x for action in actions]
+    action_array['y'] = [action.position.y for action in actions]
+    for field in ('key1', 'key2', 'mouse1', 'mouse2'):
+        action_array[field] = [getattr(action, field) for action in actions]
+
+    life_bar_graph = np.array(
+        [
+            (offset.total_seconds() * 1000, value)
+            for offset, value in replay.life_bar_graph
+        ],
+        dtype='f8',
+    ).reshape(-1, 2)
+
+    return {
+        'mode': np.array(replay.mode.value),
+        'version': np.array(replay.version),
+        'beatmap_md5': np.array(replay.beatmap_md5),
+        'player_name': np.array(replay.player_name or ''),
+        'replay_md5': np.array(replay.replay_md5 or ''),
+        'counts': np.array([getattr(replay, f) for f in _count_fields]),
+        'score': np.array(replay.score),
+        'max_combo': np.array(replay.max_combo),
+        'full_combo': np.array(replay.full_combo),
+        'mods': np.array(_mod_mask(replay)),
+        'timestamp': np.array(replay.timestamp, dtype='datetime64[us]'),
+        'life_bar_graph': life_bar_graph,
+        'actions': action_array,
+    }
+
+
+def replay_from_arrays(arrays, beatmap):
+    """Rebuild a replay from the arrays created by ``replay_to_arrays``.
+
+    Parameters
+    ----------
+    arrays : mapping[str, np.ndarray]
+        The replay data.
+    beatmap : slider.Beatmap
+        The beatmap the replay was played on.
+
+    Returns
+    -------
+    replay : slider.Replay
+        The rebuilt replay.
+    """
+    mod_kwargs = Mod.unpack(int(arrays['mods']))
+    # delete the alias field names
+    del mod_kwargs['relax2']
+    del mod_kwargs['last_mod']
+
+    # build the timedeltas positionally (days, seconds, microseconds,
+    # milliseconds), which is about twice as fast as the keyword form
+    timedelta = datetime.timedelta
+    actions = [
+        Action(
+            timedelta(0, 0, 0, offset),
+            Position(x, y),
+            key1,
+            key2,
+            mouse1,
+            mouse2,
+        )
+        for offset, x, y, key1, key2, mouse1, mouse2
+        in arrays['actions'].tolist()
+    ]
+    life_bar_graph = [
+        (datetime.timedelta(milliseconds=offset), value)
+        for offset, value in arrays['life_bar_graph'].tolist()
+    ]
+
+    return Replay(
+        mode=GameMode(int(arrays['mode'])),
+        version=int(arrays['version']),
+        beatmap_md5=str(arrays['beatmap_md5']),
+        player_name=str(arrays['player_name']),
+        replay_md5=str(arrays['replay_md5']),
+        score=int(arrays['score']),
+        max_combo=int(arrays['max_combo']),
+        full_combo=bool(arrays['full_combo']),
+        life_bar_graph=life_bar_graph,
+        timestamp=arrays['timestamp'].item(),
+        actions=actions,
+        beatmap=beatmap,
+        **dict(zip(_count_fields, arrays['counts'].tolist())),
+        **mod_kwargs,
+    )
+
+
+class ParsedReplayCache:
+    """A cache of parsed replays for a single user.
+
+    Parameters
+    ----------
+    user_replays : path-like
+        The user's replay directory.
+    version : int
+        The version of the model the replays are being loaded for. Entries for
+        other versions are ignored.
+    """
+    def __init__(self, user_replays, version):
+        self._path = pathlib.Path(user_replays) / '.parsed' / str(version)
+        self._path.mkdir(parents=True, exist_ok=True)
+
+    def _entry_path(self, digest):
+        return self._path / f'{digest}.npz'
+
+    def __contains__(self, digest):
+        return self._entry_path(digest).exists()
+
+    def __getitem__(self, digest):
+        """Read the arrays for a replay.
+
+        Parameters
+        ----------
+        digest : str
+            The hex sha256 digest of the replay file.
+
+        Returns
+        -------
+        arrays : dict[str, np.ndarray]
+            The replay data.
+
+        Raises
+        ------
+        KeyError
+            Raised when the replay is not in the cache.
+        """
+        try:
+            with np.load(self._entry_path(digest), allow_pickle=False) as f:
+                return dict(f)
+        except (FileNotFoundError, ValueError, OSError):
+            raise KeyError(digest)
+
+    def __setitem__(self, digest, arrays):
+        fd, tmp_path = tempfile.mkstemp(dir=os.fspath(self._path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.rename(tmp_path, self._entry_path(digest))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -0,0 +1,514 @@
+"""Content-addressed storage for uploaded replays.
+
+Each user's replays are stored in ``<replay-cache-dir>/<user>/<sha256>.osr``
+so that uploading the same replay twice only stores it once.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+import pathlib
+import tarfile
+import tempfile
+import time
+import traceback
+import zipfile
+
+from slider import Replay
+
+from .logging import log
+from .manifest import (
+    InvalidReplay,
+    read_replay_header,
+    validate_replay_header,
+)
+from .replay_cache import replay_from_arrays, replay_to_arrays
+
+
+class ReplayTooLarge(Exception):
+    """Raised when an uploaded replay is larger than the maximum size.
+    """
+
+
+class InvalidArchive(Exception):
+    """Raised when an uploaded archive cannot be read.
+    """
+
+
+# the suffixes of archives which may be uploaded in place of replays
+archive_suffixes = ('.zip', '.tar', '.tar.gz', '.tgz')
+
+
+def is_archive(filename):
+    """Is the given filename a replay archive?
+
+    Parameters
+    ----------
+    filename : str
+        The name of the uploaded file.
+
+    Returns
+    -------
+    is_archive : bool
+        Is this a replay archive?
+    """
+    return filename.lower().endswith(archive_suffixes)
+
+
+def is_replay(filename):
+    """Is the given filename a replay?
+
+    Parameters
+    ----------
+    filename : str
+        The name of the uploaded file.
+
+    Returns
+    -------
+    is_replay : bool
+        Is this a replay?
+    """
+    return filename.lower().endswith('.osr')
+
+
+_archive_errors = (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError)
+
+
+class _ArchiveMember:
+    """A file-like wrapper around an archive member which raises
+    ``InvalidArchive`` when the member's data is corrupt.
+    """
+    def __init__(self, filename, file):
+        self._filename = filename
+        self._file = file
+
+    def read(self, size=-1):
+        try:
+            return self._file.read(size)
+        except _archive_errors as e:
+            raise InvalidArchive(f'failed to read {self._filename}: {e}')
+
+
+def _iter_zip(stream):
+    with zipfile.ZipFile(stream) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+
+            with archive.open(info) as f:
+                yield info.filename, f
+
+
+def _iter_tar(stream):
+    # ``r|*`` reads the archive as a stream, one member at a time
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+
+            f = archive.extractfile(member)
+            try:
+                yield member.name, f
+            finally:
+                f.close()
+
+
+def iter_archive(filename, stream):
+    """Iterate over the members of an uploaded archive without extracting
+    the whole archive.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the uploaded file. This is used to pick the archive format.
+    stream : file-like
+        The archive data. Zip files must be seekable, tar files may be read
+        from a forward-only stream.
+
+    Yields
+    ------
+    name : str
+        The name of the member in the archive.
+    file : file-like
+        The member's data. This is only valid until the next member is
+        requested.
+
+    Raises
+    ------
+    InvalidArchive
+        Raised when the archive cannot be read.
+    """
+    if filename.lower().endswith('.zip'):
+        members = _iter_zip(stream)
+    else:
+        members = _iter_tar(stream)
+
+    try:
+        for name, f in members:
+            yield name, _ArchiveMember(filename, f)
+    except _archive_errors as e:
+        raise InvalidArchive(f'failed to read {filename}: {e}')
+
+
+def replay_path(user_replays, digest):
+    """Return the path to a stored replay.
+
+    Parameters
+    ----------
+    user_replays : path-like
+        The user's replay directory.
+    digest : str
+        The hex sha256 digest of the replay.
+
+    Returns
+    -------
+    path : pathlib.Path
+        The path to the replay.
+    """
+    return pathlib.Path(user_replays) / f'{digest}.osr'
+
+
+def save_replay(user_replays, stream, *, max_size, chunk_size=64 * 1024):
+    """Stream a replay to disk, hashing it as it is written.
+
+    Parameters
+    ----------
+    user_replays : path-like
+        The user's replay directory.
+    stream : file-like
+        The replay data.
+    max_size : int
+        The maximum size of a replay in bytes.
+    chunk_size : int, optional
+        The number of bytes to read from ``stream`` at a time.
+
+    Returns
+    -------
+    digest : str
+        The hex sha256 digest of the replay.
+    header : ReplayHeader
+        The replay's header.
+    new : bool
+        False if the user had already uploaded this replay.
+
+    Raises
+    ------
+    ReplayTooLarge
+        Raised when the replay is larger than ``max_size``. Nothing is saved.
+    InvalidReplay
+        Raised when the replay's header is corrupt or the replay would be
+        discarded by training. Nothing is saved.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.fspath(user_replays), suffix='.tmp')
+    try:
+        sha256 = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+
+                size += len(chunk)
+                if size > max_size:
+                    raise ReplayTooLarge(
+                        f'replay is larger than {max_size} bytes',
+                    )
+
+                sha256.update(chunk)
+                f.write(chunk)
+
+        with open(tmp_path, 'rb') as f:
+            header = read_replay_header(f)
+        validate_replay_header(header)
+
+        digest = sha256.hexdigest()
+        path = replay_path(user_replays, digest)
+        if path.exists():
+            os.unlink(tmp_path)
+            return digest, header, False
+
+        os.rename(tmp_path, path)
+        return digest, header, True
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _lookup_beatmap(client, beatmap_md5, save):
+    try:
+        return client.library.lookup_by_md5(beatmap_md5)
+    except KeyError:
+        return client.beatmap(beatmap_md5=beatmap_md5).beatmap(save=save)
+
+
+def _parse_replay(path):
+    """Parse a replay file into arrays.
+
+    This runs in the parsing processes, so errors are returned instead of
+    raised to keep one bad replay from stopping the rest.
+    """
+    try:
+        replay = Replay.from_path(path, retrieve_beatmap=False)
+        return replay_to_arrays(replay), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def parse_replays(paths, *, processes=None):
+    """Parse replay files into arrays without looking up their beatmaps.
+
+    Parameters
+    ----------
+    paths : list[path-like]
+        The paths to the replays.
+    processes : int, optional
+        The number of processes to parse with. By default the replays are
+        parsed in this process.
+
+    Yields
+    ------
+    path : path-like
+        The path to the replay.
+    arrays : dict[str, np.ndarray] or None
+        The arrays created by ``replay_to_arrays``, or None if the replay could
+        not be parsed.
+
+    Notes
+    -----
+    The worker processes send back the arrays instead of the parsed replays,
+    which are much smaller to pickle.
+    """
+    if processes is None or processes <= 1 or len(paths) < 2:
+        executor = None
+        results = map(_parse_replay, paths)
+    else:
+        executor = ProcessPoolExecutor(processes)
+        results = executor.map(
+            _parse_replay,
+            paths,
+            chunksize=max(1, len(paths) // (processes * 4)),
+        )
+
+    try:
+        for path, (arrays, error) in zip(paths, results):
+            if error is not None:
+                log.error(
+                    'failed to parse replay {path}:\n{error}',
+                    path=path,
+                    error=error,
+                )
+            yield path, arrays
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def _attach_beatmaps(parsed, client, save, timings):
+    """Rebuild parsed replays with their beatmaps.
+
+    Parameters
+    ----------
+    parsed : iterable[(any, dict[str, np.ndarray])]
+        Pairs of a key and the arrays for a replay.
+    client : slider.Client
+        The client used to find the beatmaps.
+    save : bool
+        Save beatmaps which need to be downloaded?
+    timings : dict[str, float]
+        The timings to add to.
+
+    Returns
+    -------
+    replays : list[(any, Replay)]
+        The key and replay for each replay whose beatmap could be found and
+        has at least two hit objects.
+    """
+    # many replays are often played on the same beatmap
+    beatmaps = {}
+    replays = []
+    for key, arrays in parsed:
+        beatmap_md5 = str(arrays['beatmap_md5'])
+        start = time.monotonic()
+        try:
+            beatmap = beatmaps[beatmap_md5]
+        except KeyError:
+            try:
+                beatmap = _lookup_beatmap(client, beatmap_md5, save)
+            except Exception:
+                log.exception(
+                    'failed to find beatmap {beatmap_md5}',
+                    beatmap_md5=beatmap_md5,
+                )
+                beatmap = None
+            beatmaps[beatmap_md5] = beatmap
+
+        found = time.monotonic()
+        timings['beatmaps'] += found - start
+
+        if beatmap is None or len(beatmap.hit_objects) < 2:
+            continue
+
+        replays.append((key, replay_from_arrays(arrays, beatmap)))
+        timings['parse'] += time.monotonic() - found
+
+    return replays
+
+
+def load_replays(user_replays,
+                 digests,
+                 *,
+                 client,
+                 save=False,
+                 cache=None,
+                 processes=None,
+                 progress=None,
+                 timings=None):
+    """Parse stored replays along with their beatmaps.
+
+    Parameters
+    ----------
+    user_replays : path-like
+        The user's replay directory.
+    digests : iterable[str]
+        The digests of the replays to load.
+    client : slider.Client
+        The client used to find the beatmaps.
+    save : bool, optional
+        Save beatmaps which need to be downloaded?
+    cache : ParsedReplayCache, optional
+        The cache of parsed replays. Replays in the cache are rebuilt from the
+        cached arrays instead of being parsed, and newly parsed replays are
+        added to the cache.
+    processes : int, optional
+        The number of processes to parse replays with. By default the replays
+        are parsed in this process.
+    progress : callable[int], optional
+        Called with the number of replays parsed so far as the replays are
+        loaded.
+    timings : dict[str, float], optional
+        The time in seconds spent parsing replays and finding beatmaps is
+        added to the ``'parse'`` and ``'beatmaps'`` entries.
+
+    Returns
+    -------
+    replays : list[(str, Replay)]
+        The digest and parsed replay for each replay which could be loaded.
+        Replays which fail to parse or whose beatmap has fewer than two hit
+        objects are skipped.
+    """
+    if timings is None:
+        timings = {}
+    timings.setdefault('parse', 0)
+    timings.setdefault('beatmaps', 0)
+
+    digests = list(digests)
+    done = 0
+
+    def report():
+        if progress is not None:
+            progress(done)
+
+    start = time.monotonic()
+    parsed = {}
+    to_parse = []
+    for digest in digests:
+        if cache is not None:
+            try:
+                parsed[digest] = cache[digest]
+            except KeyError:
+                pass
+            else:
+                done += 1
+                report()
+                continue
+
+        to_parse.append(digest)
+
+    results = parse_replays(
+        [replay_path(user_replays, digest) for digest in to_parse],
+        processes=processes,
+    )
+    for digest, (_, arrays) in zip(to_parse, results):
+        done += 1
+        report()
+        if arrays is None:
+            continue
+
+        parsed[digest] = arrays
+        if cache is not None:
+            cache[digest] = arrays
+
+    timings['parse'] += time.monotonic() - start
+    return _attach_beatmaps(
+        ((digest, parsed[digest]) for digest in digests if digest in parsed),
+        client,
+        save,
+        timings,
+    )
+
+
+def load_replay_directory(directory,
+                          *,
+                          client,
+                          age=None,
+                          save=False,
+                          processes=None):
+    """Parse every replay in a directory along with their beatmaps.
+
+    Parameters
+    ----------
+    directory : path-like
+        The directory of ``.osr`` files.
+    client : slider.Client
+        The client used to find the beatmaps.
+    age : datetime.timedelta, optional
+        Only load replays less than this age old.
+    save : bool, optional
+        Save beatmaps which need to be downloaded?
+    processes : int, optional
+        The number of processes to parse replays with. By default the replays
+        are parsed in this process.
+
+    Returns
+    -------
+    replays : list[Replay]
+        The replays which could be loaded.
+
+    Notes
+    -----
+    Replays are checked with ``validate_replay_header`` like uploaded
+    replays, so failed plays, unranked mods, and other game modes are
+    skipped.
+    """
+    if age is None:
+        since = float('-inf')
+    else:
+        since = time.time() - age.total_seconds()
+
+    # filter on the headers before paying to parse the replays
+    paths = []
+    for path in sorted(pathlib.Path(directory).glob('*.osr')):
+        try:
+            with open(path, 'rb') as f:
+                header = read_replay_header(f)
+            validate_replay_header(header)
+        except InvalidReplay as e:
+            log.info('skipping unusable replay {path}: {e}', path=path, e=e)
+            continue
+
+        if header.timestamp >= since:
+            paths.append(path)
+
+    parsed = [
+        (path, arrays)
+        for path, arrays in parse_replays(paths, processes=processes)
+        if arrays is not None
+    ]
+
+    timings = {'parse': 0, 'beatmaps': 0}
+    return [
+        replay for _, replay in _attach_beatmaps(parsed, client, save, timings)
+    ]
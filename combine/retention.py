@@ -0,0 +1,283 @@
+"""Removing data which training no longer uses.
+"""
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+import zipfile
+
+from lain import ErrorModel
+import pandas as pd
+
+from .logging import log
+from .manifest import ReplayManifest, manifest_path
+from .replay_store import replay_path
+
+
+def _size(path):
+    """The number of bytes used by a file or directory tree.
+    """
+    if not path.is_dir():
+        return path.stat().st_size
+
+    return sum(
+        (pathlib.Path(root) / name).stat().st_size
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def _remove(path):
+    """Remove a file or directory tree, returning the number of bytes freed.
+    """
+    size = _size(path)
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
+    return size
+
+
+def _user_dirs(root):
+    for entry in os.scandir(root):
+        if entry.is_dir() and not entry.name.startswith('.'):
+            yield pathlib.Path(entry.path)
+
+
+def remove_stale_models(model_cache_dir):
+    """Remove models and training states for old versions of ``ErrorModel``.
+
+    Parameters
+    ----------
+    model_cache_dir : path-like
+        The root model directory.
+
+    Returns
+    -------
+    reclaimed : int
+        The number of bytes freed.
+    """
+    version = str(ErrorModel.version)
+
+    reclaimed = 0
+    for user_models in _user_dirs(model_cache_dir):
+        for path in user_models.iterdir():
+            # keep the model, its training state, and any file being written
+            # for them
+            name = path.name
+            if name != version and not name.startswith(f'{version}.'):
+                reclaimed += _remove(path)
+    return reclaimed
+
+
+def remove_stale_parsed_replays(replay_cache_dir):
+    """Remove parsed replays cached for old versions of ``ErrorModel``.
+
+    Parameters
+    ----------
+    replay_cache_dir : path-like
+        The root replay directory.
+
+    Returns
+    -------
+    reclaimed : int
+        The number of bytes freed.
+    """
+    version = str(ErrorModel.version)
+
+    reclaimed = 0
+    for user_replays in _user_dirs(replay_cache_dir):
+        try:
+            entries = list((user_replays / '.parsed').iterdir())
+        except FileNotFoundError:
+            continue
+
+        for path in entries:
+            if path.name != version:
+                reclaimed += _remove(path)
+    return reclaimed
+
+
+def archive_path(user_replays):
+    """Return the path to the directory of a user's archives of old replays.
+
+    Parameters
+    ----------
+    user_replays : path-like
+        The user's replay directory.
+
+    Returns
+    -------
+    path : pathlib.Path
+        The path to the archive directory.
+
+    Notes
+    -----
+    Each run of ``archive_old_replays`` writes a new zip file into this
+    directory; existing archives are never modified.
+    """
+    return pathlib.Path(user_replays) / '.archive'
+
+
+def _write_archive(directory, paths):
+    """Durably write a new zip archive of ``paths`` into ``directory``.
+
+    Returns
+    -------
+    size : int
+        The size of the new archive in bytes.
+    """
+    directory.mkdir(exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.fspath(directory), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with zipfile.ZipFile(f, 'w', zipfile.ZIP_LZMA) as archive:
+                for path in paths:
+                    archive.write(path, path.name)
+            f.flush()
+            os.fsync(f.fileno())
+
+        path = directory / f'{time.time():.6f}.zip'
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    # make the rename durable before the replays are removed
+    dir_fd = os.open(os.fspath(directory), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+    return path.stat().st_size
+
+
+def archive_old_replays(user_replays, age):
+    """Move replays which are too old to be trained on into the user's
+    compressed archive.
+
+    Parameters
+    ----------
+    user_replays : path-like
+        The user's replay directory.
+    age : datetime.timedelta
+        The age of the replays the user trains on.
+
+    Returns
+    -------
+    reclaimed : int
+        The number of bytes freed.
+    """
+    user_replays = pathlib.Path(user_replays)
+    parsed = user_replays / '.parsed' / str(ErrorModel.version)
+
+    with ReplayManifest(user_replays) as manifest:
+        digests = manifest.select_older(age)
+        if not digests:
+            return 0
+
+        paths = [replay_path(user_replays, digest) for digest in digests]
+        reclaimed = sum(path.stat().st_size for path in paths)
+        reclaimed -= _write_archive(archive_path(user_replays), paths)
+
+        # only remove the replays once the archive is safely on disk
+        for digest, path in zip(digests, paths):
+            manifest.remove(digest)
+            path.unlink()
+            try:
+                reclaimed += _remove(parsed / f'{digest}.npz')
+            except FileNotFoundError:
+                pass
+
+    return reclaimed
+
+
+def _longest_age(user_replays, queued_ages):
+    """The longest age a user has trained with, or None if the user has
+    trained on all of their replays.
+
+    Raises
+    ------
+    KeyError
+        Raised when the user has never trained.
+    """
+    ages = set()
+    # don't create a manifest for users who have not uploaded since the
+    # manifest was added
+    if manifest_path(user_replays).exists():
+        with ReplayManifest(user_replays) as manifest:
+            try:
+                ages.add(manifest.longest_training_age())
+            except KeyError:
+                # manifests written before the training age was recorded
+                pass
+
+    # the queue stores a missing age as the string 'None'
+    ages.update(
+        pd.Timedelta(age) if age != 'None' else None for age in queued_ages
+    )
+    if not ages:
+        raise KeyError(user_replays.name)
+    if None in ages:
+        return None
+    return max(ages)
+
+
+def collect_garbage(replay_cache_dir,
+                    model_cache_dir,
+                    train_queue,
+                    archive_replays=True):
+    """Remove data which training no longer uses.
+
+    Parameters
+    ----------
+    replay_cache_dir : path-like
+        The root replay directory.
+    model_cache_dir : path-like
+        The root model directory.
+    train_queue : TrainQueue
+        The train queue. This is used to look up the ages of jobs queued
+        before the manifest recorded them.
+    archive_replays : bool, optional
+        Archive replays which are older than the longest age the user has
+        ever trained with? Users who have trained with no age limit, or
+        never trained, are not archived.
+
+    Returns
+    -------
+    reclaimed : int
+        The number of bytes freed.
+    """
+    models = remove_stale_models(model_cache_dir)
+    parsed = remove_stale_parsed_replays(replay_cache_dir)
+
+    replays = 0
+    if archive_replays:
+        queued_ages = train_queue.get_all_ages()
+        for user_replays in _user_dirs(replay_cache_dir):
+            try:
+                age = _longest_age(
+                    user_replays,
+                    queued_ages.get(user_replays.name, ()),
+                )
+            except KeyError:
+                # the user has never trained
+                continue
+
+            if age is None:
+                # the user trains on all of their replays
+                continue
+
+            replays += archive_old_replays(user_replays, age)
+
+    log.info(
+        'reclaimed {total} bytes: {models} from old models, {parsed} from'
+        ' old parsed replays, and {replays} from archiving old replays',
+        total=models + parsed + replays,
+        models=models,
+        parsed=parsed,
+        replays=replays,
+    )
+    return models + parsed + replays
@@ -0,0 +1,202 @@
+"""Retrain every user's model, for example after ``ErrorModel.version``
+changes.
+"""
+import os
+import pathlib
+import threading
+import time
+
+import pandas as pd
+
+from .logging import log
+from .manifest import ReplayManifest, manifest_path
+from .train import Status, run_train_queue
+from .utils import TrainingState
+
+
+def _last_activity(user_replays):
+    """The last time a user uploaded replays, as a unix timestamp.
+    """
+    try:
+        return manifest_path(user_replays).stat().st_mtime
+    except FileNotFoundError:
+        # the user has not uploaded since the manifest was added
+        return user_replays.stat().st_mtime
+
+
+def find_users(replay_cache_dir, model_cache_dir):
+    """Find the users whose model needs to be retrained.
+
+    Parameters
+    ----------
+    replay_cache_dir : path-like
+        The root replay directory.
+    model_cache_dir : path-like
+        The root model directory.
+
+    Returns
+    -------
+    users : list[str]
+        The users with replays but no model for the current
+        ``ErrorModel.version``, the most recently active users first.
+    """
+    candidates = []
+    for entry in os.scandir(replay_cache_dir):
+        if not entry.is_dir() or entry.name.startswith('.'):
+            continue
+
+        # the training state is written after the model is saved, so a user
+        # with a state for this version has already been retrained
+        if TrainingState.read(model_cache_dir, entry.name) is not None:
+            continue
+
+        user_replays = pathlib.Path(entry.path)
+        candidates.append((_last_activity(user_replays), entry.name))
+
+    candidates.sort(reverse=True)
+    return [user for _, user in candidates]
+
+
+def retrain_all(replay_cache_dir,
+                model_cache_dir,
+                client,
+                train_queue,
+                enqueue=True,
+                workers=None,
+                preload_worker=False,
+                max_jobs_per_user=1,
+                limits=None,
+                parse_processes=1):
+    """Retrain every user who does not yet have a model for the current
+    ``ErrorModel.version``.
+
+    Parameters
+    ----------
+    replay_cache_dir : path-like
+        The root replay directory.
+    model_cache_dir : path-like
+        The root model directory.
+    client : slider.Client
+        The client used to find beatmaps.
+    train_queue : TrainQueue
+        The train queue to add the jobs to. This is also used to look up the
+        age each user trains with.
+    enqueue : bool, optional
+        Only add the jobs to ``train_queue`` and leave them for the train
+        service. Otherwise, also run jobs from the queue here until no job
+        can be claimed.
+    workers : int, optional
+        The number of jobs to run at once when not only enqueueing. Defaults
+        to the number of cpus.
+    preload_worker : bool, optional
+        Fork each job from a preloaded worker process.
+    max_jobs_per_user : int, optional
+        The maximum number of jobs to run for a single user at once. Defaults
+        to 1.
+    limits : JobLimits, optional
+        The resources each job may use.
+    parse_processes : int, optional
+        The number of processes each job parses replays with.
+
+    Notes
+    -----
+    Users who have already been retrained are skipped, so an interrupted run
+    can be resumed by running it again. Each user is retrained with the age
+    of their most recent job which is still in the train queue.
+
+    The jobs are always claimed through ``train_queue`` so that they respect
+    the job leases and ``max_jobs_per_user`` shared with any running train
+    services.
+    """
+    users = find_users(replay_cache_dir, model_cache_dir)
+    log.info('{count} users need to be retrained', count=len(users))
+
+    ages = train_queue.get_ages()
+    # rank the jobs so that they run in order of activity instead of cost
+    for rank, user in enumerate(users):
+        age = ages.get(user)
+        # the queue stores a missing age as the string 'None'
+        if age is not None and age != 'None':
+            age = pd.Timedelta(age)
+        else:
+            age = None
+        with ReplayManifest(pathlib.Path(replay_cache_dir) / user) as m:
+            m.record_training_age(age)
+            cost = len(m.select(age=age))
+        train_queue.enqueue_job(user, age, cost=cost, bulk_rank=rank)
+    log.info('enqueued {count} train jobs', count=len(users))
+
+    if enqueue or not users:
+        return
+
+    total = len(users)
+    remaining_users = set(users)
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    def on_job_finished(user, status):
+        with lock:
+            if user not in remaining_users:
+                # an unrelated job which was already in the queue
+                return
+            remaining_users.discard(user)
+            done = total - len(remaining_users)
+
+        elapsed = time.monotonic() - start
+        rate = done / elapsed
+        log.info(
+            '{status} {user}; {done}/{total} users, {rate:.1f} users/hour,'
+            ' about {remaining:.0f} minutes remaining',
+            status='retrained' if status is Status.success else 'failed',
+            user=user,
+            done=done,
+            total=total,
+            rate=rate * 60 * 60,
+            remaining=(total - done) / rate / 60,
+        )
+
+    run_train_queue(
+        train_queue,
+        replay_cache_dir,
+        model_cache_dir,
+        client,
+        preload_worker=preload_worker,
+        workers=workers if workers is not None else os.cpu_count(),
+        max_jobs_per_user=max_jobs_per_user,
+        limits=limits,
+        parse_processes=parse_processes,
+        drain=True,
+        on_job_finished=on_job_finished,
+    )
+    elapsed = time.monotonic() - start
+
+    by_status = {status: [] for status in Status}
+    for user in users:
+        status, _, _ = train_queue.get_progress(user)
+        by_status[status].append(user)
+
+    log.info(
+        'retrained {done} of {total} users in {minutes:.0f} minutes',
+        done=len(by_status[Status.success]),
+        total=total,
+        minutes=elapsed / 60,
+    )
+    if by_status[Status.failed]:
+        log.error(
+            'failed to retrain {count} users: {users}',
+            count=len(by_status[Status.failed]),
+            users=', '.join(sorted(by_status[Status.failed])),
+        )
+    if by_status[Status.running]:
+        # these jobs were claimed by another train service
+        log.info(
+            '{count} users are still being retrained elsewhere: {users}',
+            count=len(by_status[Status.running]),
+            users=', '.join(sorted(by_status[Status.running])),
+        )
+    if by_status[Status.not_started]:
+        log.info(
+            '{count} users are still waiting to be retrained: {users}',
+            count=len(by_status[Status.not_started]),
+            users=', '.join(sorted(by_status[Status.not_started])),
+        )
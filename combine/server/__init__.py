@@ -6,17 +6,28 @@ import flask
 from gunicorn.app.base import BaseApplication
 from lain import ErrorModel
 
+from ..beatmap_cache import BeatmapCache
 from ..logging import log
-from ..utils import model_path
+from ..model_artifact import load_model as load_model_artifact
+from ..prefetch import BeatmapPrefetcher
+from ..token import VerifiedTokenCache
+from ..utils import LRUCache, model_path, model_version
 from .views import api
 
 
 def build_app(*,
               model_cache_size,
               model_cache_dir,
+              beatmap_cache_size,
+              predict_batch_max_size,
+              prediction_cache_size,
               replay_cache_dir,
+              max_replay_size,
               token_secret,
+              token_cache_size,
               client,
+              beatmap_prefetch_workers,
+              api_requests_per_minute,
               bot_user,
               github_url,
               email_address,
@@ -30,12 +41,30 @@ def build_app(*,
         The number of models to hold in memory.
     model_cache_dir : path-like
         The path to the model directory.
+    beatmap_cache_size : int
+        The number of parsed beatmaps to hold in memory.
+    predict_batch_max_size : int
+        The maximum number of beatmaps in a single batch prediction request.
+    prediction_cache_size : int
+        The number of formatted predictions to hold in memory.
     replay_cache_dir : path-like
         The path to the replay directory.
+    max_replay_size : int
+        The maximum size of a single uploaded replay in bytes.
     token_secret : bytes
         The shared secret for the web server and irc server.
+    token_cache_size : int
+        The number of verified tokens to hold in memory.
     client : Client
         The client used to fetch beatmaps.
+    beatmap_prefetch_workers : int
+        The number of threads used to download the beatmaps referenced by
+        uploaded replays.
+    api_requests_per_minute : int
+        The maximum number of osu! API requests the web server makes per
+        minute when prefetching beatmaps. Each gunicorn worker has its own
+        rate limiter, so this is divided evenly between the workers. Requests
+        made by the irc bot and the train service are not counted.
     bot_user : str
         The username of the bot.
     github_url : str
@@ -59,25 +88,63 @@ def build_app(*,
     model_cache_dir = pathlib.Path(model_cache_dir)
     replay_cache_dir = pathlib.Path(replay_cache_dir)
     token_secret = Fernet(token_secret)
+    token_cache = VerifiedTokenCache(token_cache_size)
 
     @lru_cache(model_cache_size)
-    def get_model(user):
+    def load_model(user, version):
+        model = load_model_artifact(model_cache_dir, user)
+        if model is not None:
+            return model
         try:
             return ErrorModel.load_path(model_path(model_cache_dir, user))
         except FileNotFoundError:
             raise KeyError(user)
 
+    def get_model_version(user):
+        return model_version(model_cache_dir, user)
+
+    def get_model(user, version=None):
+        # key the cache on the version so that retrained models are reloaded
+        if version is None:
+            version = get_model_version(user)
+        return load_model(user, version)
+
+    def load_beatmap(beatmap_id):
+        return client.library.lookup_by_id(
+            beatmap_id,
+            download=True,
+            save=True,
+        )
+
+    beatmap_cache = BeatmapCache(load_beatmap, beatmap_cache_size)
+    prediction_cache = LRUCache(prediction_cache_size)
+    beatmap_prefetcher = BeatmapPrefetcher(
+        client,
+        workers=beatmap_prefetch_workers,
+        # the prefetcher is copied into each gunicorn worker
+        requests_per_minute=(
+            api_requests_per_minute / gunicorn_options.get('workers', 1)
+        ),
+    )
+
     @inner_app.before_request
     def setup_globals():
         flask.g.model_cache_dir = model_cache_dir
         flask.g.replay_cache_dir = replay_cache_dir
+        flask.g.max_replay_size = max_replay_size
         flask.g.token_secret = token_secret
+        flask.g.token_cache = token_cache
         flask.g.client = client
+        flask.g.beatmap_prefetcher = beatmap_prefetcher
         flask.g.bot_user = bot_user
         flask.g.github_url = github_url
         flask.g.email_address = email_address
         flask.g.train_queue = train_queue
         flask.g.get_model = get_model
+        flask.g.get_model_version = get_model_version
+        flask.g.prediction_cache = prediction_cache
+        flask.g.beatmap_cache = beatmap_cache
+        flask.g.predict_batch_max_size = predict_batch_max_size
 
     @inner_app.errorhandler(Exception)
     def handle_error(e):
@@ -1,14 +1,23 @@
+from collections import Counter
 import datetime
+import hashlib
 import json
-import os
 
 import flask
 import pandas as pd
 from slider.mod import Mod
-from werkzeug import secure_filename
 
 from ..format_result import format_result, format_mods
 from ..logging import log
+from ..manifest import InvalidReplay, ReplayManifest
+from ..replay_store import (
+    InvalidArchive,
+    ReplayTooLarge,
+    is_archive,
+    is_replay,
+    iter_archive,
+    save_replay,
+)
 
 api = flask.Blueprint('combine-server', __name__)
 
@@ -38,8 +47,8 @@ def read_token(enc_token):
 
     Returns
     -------
-    token : dict[str, str]
-        The unencrypted token.
+    user : str
+        The user the token was issued to.
 
     Raises
     ------
@@ -47,7 +56,19 @@ def read_token(enc_token):
         Raised when the token is malformed or cannot be decrypted.
     ExpiredToken
         Raised when the token has expired.
+
+    Notes
+    -----
+    Tokens which have been verified are cached in ``flask.g.token_cache`` so
+    that repeated requests with the same token do not need to decrypt it
+    again.
     """
+    token_cache = flask.g.token_cache
+    try:
+        return token_cache[enc_token]
+    except KeyError:
+        pass
+
     try:
         token = json.loads(
             flask.g.token_secret.decrypt(
@@ -60,10 +81,63 @@ def read_token(enc_token):
     if token.keys() != {'issued', 'expires', 'user'}:
         raise ValueError('malformed token')
 
-    if pd.Timestamp.now(tz='utc') > pd.Timestamp(token['expires']):
+    expires = pd.Timestamp(token['expires'])
+    if pd.Timestamp.now(tz='utc') > expires:
         raise ExpiredToken()
 
-    return token
+    user = token['user']
+    token_cache[enc_token] = user, expires.timestamp()
+    return user
+
+
+# the number of uploaded replays between commits to the manifest
+_manifest_commit_interval = 64
+
+
+def _save_replay(user_replays, manifest, filename, stream, counts):
+    """Save a single uploaded replay.
+
+    Parameters
+    ----------
+    user_replays : pathlib.Path
+        The user's replay directory.
+    manifest : ReplayManifest
+        The user's replay manifest.
+    filename : str
+        The name of the uploaded file.
+    stream : file-like
+        The replay data.
+    counts : Counter
+        The counts of new, duplicate, oversized, and invalid replays to update.
+
+    Returns
+    -------
+    header : ReplayHeader or None
+        The header of the replay if it was accepted, otherwise None.
+    """
+    if not is_replay(filename):
+        # skip the .osg files and anything else that isn't a replay
+        return None
+
+    try:
+        digest, header, is_new = save_replay(
+            user_replays,
+            stream,
+            max_size=flask.g.max_replay_size,
+        )
+    except ReplayTooLarge:
+        counts['oversized'] += 1
+        return None
+    except InvalidReplay:
+        counts['invalid'] += 1
+        return None
+
+    manifest.add(digest, header)
+    counts['new' if is_new else 'duplicate'] += 1
+    if (counts['new'] + counts['duplicate']) % _manifest_commit_interval == 0:
+        # don't hold the manifest's write lock for the whole upload
+        manifest.commit()
+    return header
 
 
 @api.route('/train', methods=['POST'])
@@ -74,13 +148,12 @@ def train():
         return f'malformed or missing token: {type(e)}: {e}', 401
 
     try:
-        token = read_token(enc_token)
+        user = read_token(enc_token)
     except ExpiredToken:
         return 'expired token', 401
     except Exception as e:
         return str(e), 400
 
-    user = token['user']
     age = flask.request.form.get('training-days', None)
     if age:
         try:
@@ -96,11 +169,61 @@ def train():
 
     user_replays = flask.g.replay_cache_dir / user
     user_replays.mkdir(exist_ok=True)
-    for file in flask.request.files.getlist('replays'):
-        filename = secure_filename(file.filename)
-        file.save(os.fspath(user_replays / filename))
 
-    flask.g.train_queue.enqueue_job(user, age)
+    counts = Counter()
+    headers = []
+    with ReplayManifest(user_replays) as manifest:
+        for file in flask.request.files.getlist('replays'):
+            if is_archive(file.filename):
+                try:
+                    for name, member in iter_archive(
+                            file.filename,
+                            file.stream):
+                        headers.append(_save_replay(
+                            user_replays,
+                            manifest,
+                            name,
+                            member,
+                            counts,
+                        ))
+                except InvalidArchive as e:
+                    flask.flash(str(e))
+            else:
+                headers.append(_save_replay(
+                    user_replays,
+                    manifest,
+                    file.filename,
+                    file.stream,
+                    counts,
+                ))
+
+        # keep the replays this job trains on out of the archive
+        manifest.record_training_age(age)
+
+        # the number of replays the job will train on is used to estimate
+        # how long training will take when scheduling the job
+        replay_count = len(manifest.select(age=age))
+
+    # start downloading the beatmaps now so that the library is warm by the
+    # time the train job runs
+    flask.g.beatmap_prefetcher.prefetch({
+        header.beatmap_md5 for header in headers if header is not None
+    })
+    flask.g.train_queue.enqueue_job(user, age, cost=replay_count)
+
+    rejected = []
+    if counts['oversized']:
+        rejected.append(f'{counts["oversized"]} oversized')
+    if counts['invalid']:
+        rejected.append(
+            f'{counts["invalid"]} corrupt, non-standard, unranked mod, or'
+            ' failed',
+        )
+    flask.flash(
+        f'Received {counts["new"]} new replays and {counts["duplicate"]}'
+        ' duplicate replays'
+        + (f'; rejected {" and ".join(rejected)} replays.' if rejected else '.'),
+    )
     flask.flash(
         f'Your model is being trained, message {flask.g.bot_user} will message'
         ' you when your model is done training or if an error occurs.',
@@ -108,10 +231,99 @@ def train():
     return flask.redirect(flask.url_for('combine-server.index'))
 
 
+def parse_mods(mods):
+    """Parse the mods for a prediction.
+
+    Parameters
+    ----------
+    mods : str
+        The mod string, for example: ``'HDDT'``.
+
+    Returns
+    -------
+    mod_kwargs : dict[str, bool]
+        The mods to pass to the model.
+
+    Raises
+    ------
+    ValueError
+        Raised when the mods cannot be parsed or include a mod other than HD,
+        HR, DT, or HT.
+    """
+    unpacked = Mod.unpack(Mod.parse(mods))
+
+    mod_kwargs = {
+        'hard_rock': unpacked.pop('hard_rock'),
+        'double_time': unpacked.pop('double_time'),
+        'half_time': unpacked.pop('half_time'),
+        'hidden': unpacked.pop('hidden'),
+    }
+
+    if any(unpacked.values()):
+        raise ValueError('only HD, HR, DT, and HT can be used')
+
+    return mod_kwargs
+
+
+def format_prediction(beatmap, mod_kwargs, prediction):
+    """Format a prediction as a json-serializable dict.
+
+    Parameters
+    ----------
+    beatmap : Beatmap
+        The beatmap that was predicted.
+    mod_kwargs : dict[str, bool]
+        The mods used in the prediction.
+    prediction : lain.error_model.Prediction
+        The prediction to format.
+
+    Returns
+    -------
+    formatted : dict[str, any]
+        The prediction as a dict.
+    """
+    return {
+        'accuracy_mean': prediction.accuracy_mean,
+        'accuracy_std': prediction.accuracy_std,
+        'pp_mean': prediction.pp_mean,
+        'pp_std': prediction.pp_std,
+        'formatted_result': format_result(
+            beatmap,
+            format_mods(**mod_kwargs),
+            prediction,
+            show_link=False,
+        )
+    }
+
+
+def prediction_etag(user, model_version, beatmap_id, mod_kwargs):
+    """Compute the etag for a prediction.
+
+    Parameters
+    ----------
+    user : str
+        The user the prediction is for.
+    model_version : str
+        The version of the user's model.
+    beatmap_id : int
+        The id of the beatmap being predicted.
+    mod_kwargs : dict[str, bool]
+        The mods used in the prediction.
+
+    Returns
+    -------
+    etag : str
+        The etag for the prediction.
+    """
+    mods = ','.join(sorted(k for k, v in mod_kwargs.items() if v))
+    key = f'{user}:{model_version}:{beatmap_id}:{mods}'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
 @api.route('/api/predict')
 def predict():
     try:
-        token = read_token(flask.request.args['token'])
+        user = read_token(flask.request.args['token'])
     except ExpiredToken:
         return 'expired token', 401
     except Exception as e:
@@ -123,50 +335,163 @@ def predict():
         return 'missing beatmap_id argument', 400
 
     try:
-        beatmap = flask.g.client.library.lookup_by_id(
-            beatmap_id,
-            download=True,
-            save=True,
-        )
-    except KeyError:
-        return f'unknown beatmap: {beatmap_id}', 400
+        beatmap_id = int(beatmap_id)
+    except ValueError:
+        return f'malformed beatmap_id: {beatmap_id}', 400
 
-    mods = flask.request.args.get('mods', '')
     try:
-        unpacked = Mod.unpack(Mod.parse(mods))
+        mod_kwargs = parse_mods(flask.request.args.get('mods', ''))
     except ValueError as e:
         return str(e), 400
 
-    mod_kwargs = {
-        'hard_rock': unpacked.pop('hard_rock'),
-        'double_time': unpacked.pop('double_time'),
-        'half_time': unpacked.pop('half_time'),
-        'hidden': unpacked.pop('hidden'),
-    }
-
-    if any(unpacked.values()):
-        return 'only HD, HR, DT, and HT can be used', 400
-
     try:
-        model = flask.g.get_model(token['user'])
+        model_version = flask.g.get_model_version(user)
     except KeyError:
         return 'no model trained', 404
 
+    etag = prediction_etag(user, model_version, beatmap_id, mod_kwargs)
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    prediction_cache = flask.g.prediction_cache
     try:
-        prediction = model.predict(beatmap, **mod_kwargs)
-    except Exception:
-        log.exception('user {user}', user=token['user'])
-        return 'failed to make prediction', 500
+        formatted = prediction_cache[etag]
+    except KeyError:
+        try:
+            beatmap = flask.g.beatmap_cache[beatmap_id].beatmap
+        except KeyError:
+            return f'unknown beatmap: {beatmap_id}', 400
 
-    return flask.jsonify({
-        'accuracy_mean': prediction.accuracy_mean,
-        'accuracy_std': prediction.accuracy_std,
-        'pp_mean': prediction.pp_mean,
-        'pp_std': prediction.pp_std,
-        'formatted_result': format_result(
+        try:
+            model = flask.g.get_model(user, model_version)
+        except KeyError:
+            return 'no model trained', 404
+
+        try:
+            prediction = model.predict(beatmap, **mod_kwargs)
+        except Exception:
+            log.exception('user {user}', user=user)
+            return 'failed to make prediction', 500
+
+        formatted = prediction_cache[etag] = format_prediction(
             beatmap,
-            format_mods(**mod_kwargs),
+            mod_kwargs,
             prediction,
-            show_link=False,
         )
-    })
+
+    response = flask.jsonify(formatted)
+    response.set_etag(etag)
+    return response
+
+
+def _predict_batch_item(model, model_version, user, item):
+    """Make a single prediction for ``predict_batch``.
+
+    Parameters
+    ----------
+    model : ErrorModel
+        The user's model.
+    model_version : str
+        The version of the user's model.
+    user : str
+        The user the prediction is for.
+    item : dict[str, any]
+        The item from the request with a ``beatmap_id`` and optional ``mods``.
+
+    Returns
+    -------
+    result : dict[str, any]
+        The formatted prediction or an ``error`` entry.
+    """
+    if not isinstance(item, dict) or 'beatmap_id' not in item:
+        return {'error': 'missing beatmap_id'}
+
+    beatmap_id = item['beatmap_id']
+    result = {'beatmap_id': beatmap_id, 'mods': item.get('mods', '')}
+
+    try:
+        beatmap_id = int(beatmap_id)
+    except (TypeError, ValueError):
+        result['error'] = f'malformed beatmap_id: {beatmap_id}'
+        return result
+
+    try:
+        mod_kwargs = parse_mods(result['mods'])
+    except (TypeError, ValueError) as e:
+        result['error'] = str(e)
+        return result
+
+    prediction_cache = flask.g.prediction_cache
+    etag = prediction_etag(user, model_version, beatmap_id, mod_kwargs)
+    try:
+        result.update(prediction_cache[etag])
+        return result
+    except KeyError:
+        pass
+
+    try:
+        beatmap = flask.g.beatmap_cache[beatmap_id].beatmap
+    except KeyError:
+        result['error'] = f'unknown beatmap: {beatmap_id}'
+        return result
+
+    try:
+        prediction = model.predict(beatmap, **mod_kwargs)
+    except Exception:
+        log.exception('user {user}', user=user)
+        result['error'] = 'failed to make prediction'
+        return result
+
+    formatted = prediction_cache[etag] = format_prediction(
+        beatmap,
+        mod_kwargs,
+        prediction,
+    )
+    result.update(formatted)
+    return result
+
+
+@api.route('/api/predict_batch', methods=['POST'])
+def predict_batch():
+    """Make predictions for many beatmaps at once.
+
+    The request body is a json object with a ``token`` and a list of
+    ``beatmaps``, where each beatmap is an object with a ``beatmap_id`` and
+    optional ``mods``. The response is streamed back as one json object per
+    line in the same order as the request. Items which fail have an ``error``
+    entry instead of a prediction.
+    """
+    request = flask.request.get_json(silent=True)
+    if not isinstance(request, dict):
+        return 'request body must be a json object', 400
+
+    try:
+        user = read_token(request['token'])
+    except ExpiredToken:
+        return 'expired token', 401
+    except Exception as e:
+        return str(e), 400
+
+    items = request.get('beatmaps')
+    if not isinstance(items, list):
+        return 'beatmaps must be a list', 400
+
+    max_size = flask.g.predict_batch_max_size
+    if len(items) > max_size:
+        return f'at most {max_size} beatmaps may be predicted at once', 413
+
+    try:
+        model_version = flask.g.get_model_version(user)
+        model = flask.g.get_model(user, model_version)
+    except KeyError:
+        return 'no model trained', 404
+
+    @flask.stream_with_context
+    def generate():
+        for item in items:
+            result = _predict_batch_item(model, model_version, user, item)
+            yield json.dumps(result) + '\n'
+
+    return flask.Response(generate(), mimetype='application/x-ndjson')
@@ -1,7 +1,10 @@
 import json
+import time
 
 import pandas as pd
 
+from .utils import LRUCache
+
 
 def gen_token(token_secret, user, *, expires=None):
     """Generate a token for a user.
@@ -33,3 +36,35 @@ def gen_token(token_secret, user, *, expires=None):
             'user': user,
         }).encode('utf-8')
     ).decode('utf-8')
+
+
+class VerifiedTokenCache:
+    """A bounded mapping from encrypted tokens which have already been
+    decrypted and verified to the user and expiration time of the token.
+
+    Parameters
+    ----------
+    maxsize : int or None
+        The maximum number of tokens to hold. None will hold all tokens.
+
+    Notes
+    -----
+    Entries are stored as ``(user, expires)`` pairs where ``expires`` is a
+    unix timestamp. Entries are evicted when they are looked up after they
+    have expired or when the cache is full.
+    """
+    def __init__(self, maxsize):
+        self._entries = LRUCache(maxsize)
+
+    def __setitem__(self, enc_token, user_expires):
+        self._entries[enc_token] = user_expires
+
+    def __getitem__(self, enc_token):
+        user, expires = self._entries[enc_token]
+        if time.time() >= expires:
+            self._entries.pop(enc_token, None)
+            raise KeyError(enc_token)
+        return user
+
+    def __len__(self):
+        return len(self._entries)
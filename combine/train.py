@@ -1,14 +1,82 @@
+from contextlib import contextmanager
 from enum import unique, Enum
+import json
+import multiprocessing
 import os
+import pathlib
+import socket
 import sqlite3
 import subprocess
 import sys
-from time import sleep
+import tempfile
+import threading
+import time
 
+from .limits import (
+    JobLimits,
+    JobUsage,
+    apply_limits,
+    kill_tree,
+    monitor,
+    wait4,
+)
 from .logging import log
 from . import _train_runner
 
 
+def _listen(directory):
+    """Create a socket which receives a datagram whenever ``_notify`` is
+    called for ``directory``.
+    """
+    directory.mkdir(exist_ok=True)
+    path = directory / f'{os.getpid()}.sock'
+    try:
+        # left over from a previous process with the same pid
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(os.fspath(path))
+    return sock
+
+
+def _notify(directory):
+    """Send a datagram to every socket listening on ``directory``.
+    """
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        # nothing has ever listened
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        for entry in entries:
+            try:
+                sock.sendto(b'\0', entry.path)
+            except ConnectionRefusedError:
+                # the listening process exited without removing its socket
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+            except OSError:
+                # the listener's buffer is full, so it has already been woken
+                pass
+
+
+def _close_listener(sock):
+    """Close a socket created by ``_listen`` and remove its path.
+    """
+    path = sock.getsockname()
+    sock.close()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
 @unique
 class Status(Enum):
     """The status of a job.
@@ -19,6 +87,13 @@ class Status(Enum):
     success = 'success'
 
 
+def _decay(elapsed, half_life):
+    """The factor which halves every ``half_life`` seconds of ``elapsed``.
+    """
+    # clamp clock skew so that a job inserted "in the future" cannot overflow
+    return 2.0 ** (-max(elapsed, 0) / half_life)
+
+
 class TrainQueue:
     """A queue of training work to be done.
 
@@ -26,33 +101,109 @@ class TrainQueue:
     ----------
     train_queue_db : path-like
         The underlying queue database path.
+    check_same_thread : bool, optional
+        Only allow the queue to be used from the thread that created it? When
+        this is False, the caller must ensure that the queue is not used from
+        two threads at once.
     """
-    def __init__(self, train_queue_db_path):
+    # the number of seconds a worker may hold a job without renewing its
+    # lease before the job is given to another worker
+    lease_duration = 60
+
+    # how far back to look for a user's previous jobs when sharing the
+    # workers between users
+    fair_share_window = '-1 day'
+
+    # the number of seconds a job must wait for its priority score to halve;
+    # this keeps large jobs from being starved by a steady stream of small
+    # jobs
+    priority_half_life = 60 * 60
+
+    def __init__(self, train_queue_db_path, check_same_thread=True):
         self._db_path = train_queue_db_path
-        self._db = sqlite3.connect(os.fspath(train_queue_db_path))
-        self._db.execute(
+        self._wakeup_dir = pathlib.Path(
+            os.fspath(train_queue_db_path) + '.wakeup',
+        )
+        self._completed_dir = pathlib.Path(
+            os.fspath(train_queue_db_path) + '.completed',
+        )
+        self._db = db = sqlite3.connect(
+            os.fspath(train_queue_db_path),
+            timeout=30,
+            check_same_thread=check_same_thread,
+        )
+        # let the web servers, trainers, and irc bot read while a job is being
+        # claimed or enqueued
+        db.execute('pragma journal_mode=wal')
+        # sqlite has no ``pow`` before 3.35
+        db.create_function('decay', 2, _decay)
+        db.execute(
             """
             create table if not exists queue (
                 user string not null,
                 age str not null,
                 status string not null,
                 insert_time int not null,
-                reported bool not null
+                reported bool not null,
+                worker string,
+                lease_expires real,
+                cost int,
+                wait_time real,
+                progress string,
+                timings string,
+                failure_reason string,
+                peak_rss int,
+                cpu_time real,
+                bulk_rank int
             )
             """,
         )
+        columns = {row[1] for row in db.execute('pragma table_info(queue)')}
+        # columns added after the queue was first created
+        for name, type_ in (('worker', 'string'),
+                            ('lease_expires', 'real'),
+                            ('cost', 'int'),
+                            ('wait_time', 'real'),
+                            ('progress', 'string'),
+                            ('timings', 'string'),
+                            ('failure_reason', 'string'),
+                            ('peak_rss', 'int'),
+                            ('cpu_time', 'real'),
+                            ('bulk_rank', 'int')):
+            if name not in columns:
+                db.execute(f'alter table queue add column {name} {type_}')
 
-    def copy(self):
+        for name, columns in (('status_insert_time', 'status, insert_time'),
+                              ('reported_status', 'reported, status'),
+                              ('user_status', 'user, status')):
+            db.execute(
+                f'create index if not exists queue_{name}'
+                f' on queue ({columns})',
+            )
+        db.commit()
+
+    def copy(self, check_same_thread=True):
         """Create a copy suitable for use in a new thread.
 
+        Parameters
+        ----------
+        check_same_thread : bool, optional
+            Only allow the copy to be used from the thread that created it?
+
         Returns
         -------
         TrainQueue
             The new copy.
         """
-        return type(self)(self._db_path)
+        return type(self)(self._db_path, check_same_thread=check_same_thread)
+
+    @property
+    def db_path(self):
+        """The path to the underlying queue database.
+        """
+        return self._db_path
 
-    def enqueue_job(self, user, age):
+    def enqueue_job(self, user, age, cost=None, bulk_rank=None):
         """Enqueue a new job to run when there is time available.
 
         Parameters
@@ -61,29 +212,249 @@ class TrainQueue:
             The user to train for.
         age : datetime.timedelta or None
             The age threshold in days for training.
+        cost : int, optional
+            The estimated cost of the job, for example the number of replays
+            the user has. Cheaper jobs are run first.
+        bulk_rank : int, optional
+            The position of the job in a bulk run like ``retrain-all``. Bulk
+            jobs run after every other job, in order of increasing rank,
+            regardless of their cost.
+
+        Notes
+        -----
+        A user has at most one job waiting to run. If the user already has a
+        job waiting, that job is updated to use ``age`` instead of adding a
+        new job. A job which is already running does not count, so a user who
+        uploads during training gets one follow-up job. A waiting job only
+        stays a bulk job if both jobs are bulk jobs.
         """
-        self._db.execute(
-            "insert into queue values (?, ?, ?, datetime('now'), 0)",
-            (user, str(age), Status.not_started.value),
-        )
-        self._db.commit()
+        db = self._db
+        # lock the database so that two servers cannot both insert a job for
+        # the same user
+        db.execute('begin immediate')
+        try:
+            cursor = db.execute(
+                """
+                update queue set
+                    age=?,
+                    cost=?,
+                    bulk_rank=case when bulk_rank is null then null else ? end
+                where user=? and status=?
+                """,
+                (str(age), cost, bulk_rank, user, Status.not_started.value),
+            )
+            if not cursor.rowcount:
+                db.execute(
+                    """
+                    insert into queue (
+                        user,
+                        age,
+                        status,
+                        insert_time,
+                        reported,
+                        cost,
+                        bulk_rank
+                    ) values (?, ?, ?, datetime('now'), 0, ?, ?)
+                    """,
+                    (
+                        user,
+                        str(age),
+                        Status.not_started.value,
+                        cost,
+                        bulk_rank,
+                    ),
+                )
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+
+        _notify(self._wakeup_dir)
+
+    def listen_for_jobs(self):
+        """Create a socket which receives a datagram whenever a job is
+        enqueued.
+
+        Returns
+        -------
+        sock : socket.socket
+            The socket to wait on. Close it with ``close_listener``.
+        """
+        return _listen(self._wakeup_dir)
+
+    def listen_for_completed_jobs(self):
+        """Create a socket which receives a datagram whenever a job
+        completes.
+
+        Returns
+        -------
+        sock : socket.socket
+            The socket to wait on. Close it with ``close_listener``.
+        """
+        return _listen(self._completed_dir)
+
+    @staticmethod
+    def close_listener(sock):
+        """Close a socket created by ``listen_for_jobs`` or
+        ``listen_for_completed_jobs``.
+
+        Parameters
+        ----------
+        sock : socket.socket
+            The socket to close.
+        """
+        _close_listener(sock)
 
     class Empty(Exception):
         pass
 
-    def get_job(self):
-        """Get a job from the queue, if no jobs are waiting to be run, raise
+    # jobs which may be claimed: jobs which have not started and jobs whose
+    # worker stopped renewing its lease, as long as the user does not
+    # already have ``max_jobs_per_user`` jobs running
+    _claimable = """
+        (queue.status=? or (queue.status=? and queue.lease_expires < ?)) and (
+            select count(*) from queue as other
+            where other.user=queue.user and
+                  other.status=? and
+                  other.lease_expires >= ?
+        ) < ?
+    """
+
+    # Jobs are run in order of increasing priority score. The score is the
+    # job's cost scaled by the number of jobs the user has had recently, so
+    # small jobs and users who have not trained recently go first. The score
+    # halves every ``priority_half_life`` seconds the job waits.
+    _priority = """
+        (
+            1 + (
+                select count(*) from queue as other
+                where other.user=queue.user and
+                      other.status!=? and
+                      other.insert_time >= datetime('now', ?)
+            )
+        ) * (1 + coalesce(queue.cost, 0)) * decay(
+            (julianday('now') - julianday(queue.insert_time)) * 86400,
+            ?
+        )
+    """
+
+    def get_job(self, worker, max_jobs_per_user=1):
+        """Claim a job from the queue, if no jobs are waiting to be run, raise
         ``Empty``.
+
+        Parameters
+        ----------
+        worker : str
+            The name of the worker claiming the job.
+        max_jobs_per_user : int, optional
+            The maximum number of jobs to run for a single user at once. By
+            default a user's jobs are run one at a time, since concurrent
+            jobs for one user race on the user's manifest, parsed replays,
+            and model.
+
+        Returns
+        -------
+        rowid : int
+            The id of the job.
+        user : str
+            The user to train for.
+        age : str
+            The age threshold for training.
+
+        Notes
+        -----
+        The job is leased to ``worker`` for ``lease_duration`` seconds. The
+        worker must call ``renew_lease`` while the job runs, otherwise the job
+        is assumed to have crashed and may be claimed by another worker.
+
+        The time the job spent waiting in the queue is recorded in the
+        ``wait_time`` column.
         """
-        results = list(self._db.execute(
-            'select rowid, user, age from queue where status=?'
-            ' order by insert_time limit 1',
-            (Status.not_started.value,),
-        ))
-        if not results:
-            raise self.Empty()
+        while True:
+            now = time.time()
+            claimable = (
+                Status.not_started.value,
+                Status.running.value,
+                now,
+                Status.running.value,
+                now,
+                max_jobs_per_user,
+            )
+            results = list(self._db.execute(
+                f'select rowid, user, age, status from queue'
+                f' where {self._claimable}'
+                # bulk jobs run last, in the order they were ranked
+                f' order by bulk_rank is not null, bulk_rank,'
+                f' {self._priority}, insert_time limit 1',
+                claimable + (
+                    Status.not_started.value,
+                    self.fair_share_window,
+                    self.priority_half_life,
+                ),
+            ))
+            if not results:
+                raise self.Empty()
+
+            (rowid, user, age, status), = results
+
+            # only claim the job if no other worker claimed it between the
+            # select and the update
+            cursor = self._db.execute(
+                f"""
+                update queue set
+                    status=?,
+                    worker=?,
+                    lease_expires=?,
+                    wait_time=coalesce(
+                        wait_time,
+                        (julianday('now') - julianday(insert_time)) * 86400
+                    )
+                where rowid=? and {self._claimable}
+                """,
+                (
+                    Status.running.value,
+                    worker,
+                    now + self.lease_duration,
+                    rowid,
+                ) + claimable,
+            )
+            self._db.commit()
+            if cursor.rowcount:
+                if status == Status.running.value:
+                    log.warning(
+                        'reclaimed train job for user {user} from a crashed'
+                        ' worker',
+                        user=user,
+                    )
+                return rowid, user, age
+
+    def renew_lease(self, rowid, worker):
+        """Extend the lease on a running job.
+
+        Parameters
+        ----------
+        rowid : int
+            The row id returned from ``get_job``.
+        worker : str
+            The name of the worker which claimed the job.
 
-        return results[0]
+        Returns
+        -------
+        renewed : bool
+            False if the job is no longer leased to ``worker``.
+        """
+        cursor = self._db.execute(
+            'update queue set lease_expires=?'
+            ' where rowid=? and worker=? and status=?',
+            (
+                time.time() + self.lease_duration,
+                rowid,
+                worker,
+                Status.running.value,
+            ),
+        )
+        self._db.commit()
+        return bool(cursor.rowcount)
 
     def get_completed_jobs(self):
         """Get all of the completed jobs that have not been reported.
@@ -93,72 +464,500 @@ class TrainQueue:
         completed : list[(str, str)]
             A list of (user name, status) pairs for each newly completed task.
         """
-        results = self._db.execute(
+        db = self._db
+        completed = (Status.success.value, Status.failed.value)
+
+        # lock the database so that no job can finish between reading the
+        # completed jobs and marking them as reported
+        db.execute('begin immediate')
+        try:
+            out = [
+                (user, Status(status))
+                for user, status in db.execute(
+                    'select user, status from queue'
+                    ' where not reported and status in (?, ?)',
+                    completed,
+                )
+            ]
+            if out:
+                db.execute(
+                    'update queue set reported=1'
+                    ' where not reported and status in (?, ?)',
+                    completed,
+                )
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+        return out
+
+    def prune(self, age):
+        """Delete finished jobs which have been reported.
+
+        Parameters
+        ----------
+        age : datetime.timedelta
+            Only delete jobs which were enqueued at least this long ago.
+
+        Returns
+        -------
+        pruned : int
+            The number of jobs deleted.
+        """
+        cursor = self._db.execute(
             """
-            select rowid, user, status from queue
-            where not reported and (status == ? or status == ?)
+            delete from queue
+            where reported and
+                  status in (?, ?) and
+                  insert_time < datetime('now', ?)
             """,
-            (Status.success.value, Status.failed.value)
+            (
+                Status.success.value,
+                Status.failed.value,
+                f'-{int(age.total_seconds())} seconds',
+            ),
         )
-        out = []
-        for rowid, user, status in results:
-            out.append((user, Status(status)))
-            self._db.execute(
-                'update queue set reported=1 where rowid=?',
-                (rowid,),
-            )
-
         self._db.commit()
-        return out
+        return cursor.rowcount
 
-    def update_status(self, rowid, status):
+    def update_status(self, rowid, status, worker=None, reason=None):
         """Update the status of a job.
 
         Parameters
         ----------
         rowid : int
-            The row id returned from ``get``.
+            The row id returned from ``get_job``.
         status : Status
             The new status to set.
+        worker : str, optional
+            Only update the job if it is still leased to this worker.
+        reason : str, optional
+            Why the job failed.
+        """
+        if worker is None:
+            cursor = self._db.execute(
+                'update queue set status=?, failure_reason=? where rowid=?',
+                (status.value, reason, rowid),
+            )
+        else:
+            cursor = self._db.execute(
+                'update queue set status=?, failure_reason=?'
+                ' where rowid=? and worker=?',
+                (status.value, reason, rowid, worker),
+            )
+        self._db.commit()
+
+        if cursor.rowcount and status in (Status.success, Status.failed):
+            _notify(self._completed_dir)
+
+    def update_progress(self, rowid, progress):
+        """Record the progress of a running job.
+
+        Parameters
+        ----------
+        rowid : int
+            The row id returned from ``get_job``.
+        progress : dict[str, any]
+            The job's progress. This has a ``stage`` entry and, for stages
+            which process many items, ``done`` and ``total`` entries.
         """
         self._db.execute(
-            'update queue set status=? where rowid=?',
-            (status.value, rowid),
+            'update queue set progress=? where rowid=?',
+            (json.dumps(progress), rowid),
         )
         self._db.commit()
 
+    def record_timings(self, rowid, timings):
+        """Record how long a job spent in each stage.
 
-def _run_train_job(user, age_str, replay_cache_dir, model_cache_dir, client):
-    log.info('starting train job for user: {user}', user=user)
+        Parameters
+        ----------
+        rowid : int
+            The row id returned from ``get_job``.
+        timings : dict[str, float]
+            The number of seconds spent in each stage.
+        """
+        self._db.execute(
+            'update queue set timings=? where rowid=?',
+            (json.dumps(timings), rowid),
+        )
+        self._db.commit()
+
+    def record_usage(self, rowid, usage):
+        """Record the resources a job used.
+
+        Parameters
+        ----------
+        rowid : int
+            The row id returned from ``get_job``.
+        usage : JobUsage
+            The resources the job used.
+        """
+        self._db.execute(
+            'update queue set peak_rss=?, cpu_time=? where rowid=?',
+            (usage.peak_rss, usage.cpu_time, rowid),
+        )
+        self._db.commit()
+
+    def get_ages(self):
+        """Get the age threshold of each user's most recent job.
+
+        Returns
+        -------
+        ages : dict[str, str]
+            The age of each user's most recent job.
+        """
+        return {
+            user: age
+            for user, age in self._db.execute(
+                'select user, age from queue order by rowid',
+            )
+        }
+
+    def get_all_ages(self):
+        """Get the age thresholds of all of each user's jobs.
+
+        Returns
+        -------
+        ages : dict[str, set[str]]
+            The ages of each user's jobs which are still in the queue.
+        """
+        ages = {}
+        for user, age in self._db.execute(
+                'select distinct user, age from queue'):
+            ages.setdefault(user, set()).add(age)
+        return ages
+
+    def get_progress(self, user):
+        """Get the state of a user's most recent job.
+
+        Parameters
+        ----------
+        user : str
+            The user to look up.
+
+        Returns
+        -------
+        status : Status
+            The status of the job.
+        progress : dict[str, any] or None
+            The last progress recorded by the job.
+        timings : dict[str, float] or None
+            The number of seconds the job spent in each stage so far.
+
+        Raises
+        ------
+        KeyError
+            Raised when the user has no jobs.
+        """
+        results = list(self._db.execute(
+            'select status, progress, timings from queue where user=?'
+            ' order by rowid desc limit 1',
+            (user,),
+        ))
+        if not results:
+            raise KeyError(user)
+
+        (status, progress, timings), = results
+        return (
+            Status(status),
+            json.loads(progress) if progress is not None else None,
+            json.loads(timings) if timings is not None else None,
+        )
+
+
+class JobProgress:
+    """Record the progress and stage timings of a running train job.
+
+    Parameters
+    ----------
+    train_queue : TrainQueue or None
+        The queue the job was claimed from. If None, progress is not recorded.
+    rowid : int or None
+        The row id of the job.
+    """
+    # the minimum number of seconds between progress writes
+    _update_interval = 1
+
+    def __init__(self, train_queue, rowid):
+        self._train_queue = train_queue
+        self._rowid = rowid
+        self._last_update = 0
+        self.timings = {}
+
+    def update(self, stage, done=None, total=None, force=False):
+        """Record the job's progress.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the current stage.
+        done : int, optional
+            The number of items processed in the current stage.
+        total : int, optional
+            The total number of items to process in the current stage.
+        force : bool, optional
+            Write the progress even if it was written recently.
+        """
+        if self._train_queue is None:
+            return
+
+        now = time.monotonic()
+        if not force and now - self._last_update < self._update_interval:
+            return
+
+        self._last_update = now
+        progress = {'stage': stage}
+        if done is not None:
+            progress['done'] = done
+        if total is not None:
+            progress['total'] = total
+        self._train_queue.update_progress(self._rowid, progress)
+
+    @contextmanager
+    def stage(self, name, total=None):
+        """Time a stage of the job.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        total : int, optional
+            The total number of items to process in this stage.
+        """
+        self.update(name, 0 if total is not None else None, total, force=True)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[name] = (
+                self.timings.get(name, 0) + time.monotonic() - start
+            )
+            if self._train_queue is not None:
+                self._train_queue.record_timings(self._rowid, self.timings)
+
+
+def _noop():
+    pass
+
+
+def _combine_usage(exact, monitored):
+    """Combine the usage reported when a job exits with the usage sampled
+    while it ran.
+
+    The exact usage includes the cpu time of the job's children, but its
+    peak rss is only the largest single process. The sampled peak rss is the
+    job and its children together.
+    """
+    return JobUsage(
+        peak_rss=max(exact.peak_rss, monitored.peak_rss or 0),
+        cpu_time=exact.cpu_time,
+    )
+
+
+class PreloadedTrainWorker:
+    """Run train jobs in processes forked from a server which has already
+    imported the training dependencies.
+
+    Each job still runs in its own process, so a crash only fails that job,
+    but the job does not need to start a new interpreter and import lain,
+    pandas, and slider.
+    """
+    def __init__(self):
+        self._context = context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(_train_runner.preload_modules)
+
+        # start the fork server now to pay for the imports up front
+        start = time.monotonic()
+        process = context.Process(target=_noop)
+        process.start()
+        process.join()
+        self.preload_duration = time.monotonic() - start
+        log.info(
+            'preloaded train worker in {duration:.2f}s',
+            duration=self.preload_duration,
+        )
+
+    def run(self, kwargs, limits):
+        """Run a train job.
+
+        Parameters
+        ----------
+        kwargs : dict[str, any]
+            The arguments to forward to ``_train_runner.train``.
+        limits : JobLimits
+            The resources the job may use.
+
+        Returns
+        -------
+        returncode : int
+            The exit code of the job.
+        stderr : str
+            The job's stderr.
+        reason : str or None
+            Why the job was killed, or None if it exited on its own.
+        usage : JobUsage
+            The resources the job used.
+        """
+        context = self._context
+        started_at = context.Value('d', 0.0)
+        # the peak rss and cpu time, written by the job when it exits
+        exact_usage = context.Array('d', 2)
+        with tempfile.NamedTemporaryFile() as stderr:
+            spawned_at = time.time()
+            process = context.Process(
+                target=_train_runner.run_in_worker,
+                args=(stderr.name, started_at, exact_usage, limits, kwargs),
+            )
+            # the job applies its niceness and cpu affinity itself, so a
+            # failure to apply them fails the job like any other error
+            process.start()
+
+            def wait(timeout):
+                process.join(timeout)
+                return process.exitcode
+
+            returncode, reason, usage = monitor(process.pid, wait, limits)
+
+            if started_at.value:
+                startup = started_at.value - spawned_at
+                log.info(
+                    'train job started in {startup:.3f}s, saving about'
+                    ' {saved:.2f}s of imports',
+                    startup=startup,
+                    saved=self.preload_duration - startup,
+                )
+
+            peak_rss, cpu_time = exact_usage
+            if peak_rss:
+                usage = _combine_usage(
+                    JobUsage(peak_rss=int(peak_rss), cpu_time=cpu_time),
+                    usage,
+                )
+
+            stderr.seek(0)
+            return (
+                returncode,
+                stderr.read().decode('utf-8', errors='replace'),
+                reason,
+                usage,
+            )
+
+
+def _run_train_subprocess(kwargs, limits):
     args = [
         sys.executable, '-m', _train_runner.__name__,
-        '--user', user,
-        '--replay-cache-dir', os.fspath(replay_cache_dir),
-        '--model-cache-dir', os.fspath(model_cache_dir),
-        '--library', client.library.path,
-        '--api-key', client.api_key,
+        '--user', kwargs['user'],
+        '--replay-cache-dir', os.fspath(kwargs['replay_cache_dir']),
+        '--model-cache-dir', os.fspath(kwargs['model_cache_dir']),
+        '--library', os.fspath(kwargs['library']),
+        '--api-key', kwargs['api_key'],
+        '--parse-processes', str(kwargs['parse_processes']),
     ]
 
-    if age_str is not None:
+    if kwargs['age'] is not None:
         args.extend((
-            '--age', age_str
+            '--age', kwargs['age'],
         ))
 
-    result = subprocess.run(
-        args,
-        stderr=subprocess.PIPE,
-        encoding='utf-8',
-    )
-    failed = result.returncode != 0
+    if kwargs['job_id'] is not None:
+        args.extend((
+            '--train-queue-db', os.fspath(kwargs['train_queue_db']),
+            '--job-id', str(kwargs['job_id']),
+        ))
+
+    # write stderr to a file so that the job cannot block on a full pipe
+    # while it is being monitored
+    with tempfile.TemporaryFile() as stderr:
+        # start the job in its own session so that it can be killed along
+        # with its replay parsing processes
+        process = subprocess.Popen(
+            args,
+            stderr=stderr,
+            start_new_session=True,
+        )
+        try:
+            apply_limits(process.pid, limits)
+        except BaseException:
+            # don't leave the job running unmonitored
+            kill_tree(process.pid)
+            process.wait()
+            raise
+
+        exact_usage = []
+
+        def wait(timeout):
+            result = wait4(process.pid, timeout)
+            if result is None:
+                return None
+
+            returncode, usage = result
+            exact_usage.append(usage)
+            # the process has been reaped, don't let ``Popen`` wait for it
+            process.returncode = returncode
+            return returncode
+
+        returncode, reason, usage = monitor(process.pid, wait, limits)
+        if exact_usage:
+            usage = _combine_usage(exact_usage[0], usage)
+
+        stderr.seek(0)
+        return (
+            returncode,
+            stderr.read().decode('utf-8', errors='replace'),
+            reason,
+            usage,
+        )
+
+
+def _run_train_job(user,
+                   age_str,
+                   replay_cache_dir,
+                   model_cache_dir,
+                   client,
+                   worker=None,
+                   limits=None,
+                   parse_processes=1,
+                   train_queue_db=None,
+                   job_id=None):
+    log.info('starting train job for user: {user}', user=user)
+    kwargs = {
+        'user': user,
+        'replay_cache_dir': replay_cache_dir,
+        'model_cache_dir': model_cache_dir,
+        'age': age_str,
+        'parse_processes': parse_processes,
+        'library': client.library.path,
+        'api_key': client.api_key,
+        'train_queue_db': train_queue_db,
+        'job_id': job_id,
+    }
+
+    if limits is None:
+        limits = JobLimits.unlimited()
+
+    if worker is None:
+        returncode, stderr, reason, usage = _run_train_subprocess(
+            kwargs,
+            limits,
+        )
+    else:
+        returncode, stderr, reason, usage = worker.run(kwargs, limits)
+
+    failed = returncode != 0
     if failed:
+        if reason is None:
+            reason = f'exited with code {returncode}'
+
         log.error(
-            'failed train job for user: {user}; params:\n'
+            'failed train job for user: {user} ({reason}); params:\n'
             '--replay-cache-dir={replay_cache_dir}\n'
             '--model-cache-dir={model_cache_dir}\n'
             '--library={library!s}\n'
             '--api-key={censored_api_key}\n\n'
             '{stderr}',
             user=user,
+            reason=reason,
             replay_cache_dir=os.fspath(replay_cache_dir),
             model_cache_dir=os.fspath(model_cache_dir),
             library=client.library.path,
@@ -167,15 +966,117 @@ def _run_train_job(user, age_str, replay_cache_dir, model_cache_dir, client):
                 if client.api_key else
                 '<empty string>'
             ),
-            stderr=result.stderr,
+            stderr=stderr,
         )
-    return failed
+    return failed, reason, usage
+
+
+def _renew_lease(train_queue, rowid, worker, done):
+    """Renew the lease on a job until ``done`` is set.
+    """
+    train_queue = train_queue.copy()
+    while not done.wait(train_queue.lease_duration / 3):
+        if not train_queue.renew_lease(rowid, worker):
+            log.warning(
+                'train job {rowid} is no longer leased to {worker}',
+                rowid=rowid,
+                worker=worker,
+            )
+            return
+
+
+def _train_worker(train_queue,
+                  wakeup,
+                  worker,
+                  max_jobs_per_user,
+                  job_args,
+                  on_job_finished=None):
+    """Claim and run jobs from the queue for ever, or until no job can be
+    claimed when ``wakeup`` is None.
+    """
+    # sqlite connections may not be shared between threads
+    train_queue = train_queue.copy()
+    while True:
+        try:
+            rowid, user, agestr = train_queue.get_job(
+                worker,
+                max_jobs_per_user=max_jobs_per_user,
+            )
+        except TrainQueue.Empty:
+            log.debug('no jobs')
+            if wakeup is None:
+                return
+            try:
+                # each enqueued job wakes one idle worker
+                wakeup.recv(1)
+            except socket.timeout:
+                pass
+            continue
+
+        done = threading.Event()
+        heartbeat = threading.Thread(
+            target=_renew_lease,
+            args=(train_queue, rowid, worker, done),
+            daemon=True,
+        )
+        heartbeat.start()
+        reason = None
+        try:
+            failed, reason, usage = _run_train_job(
+                user,
+                agestr,
+                *job_args,
+                train_queue_db=train_queue.db_path,
+                job_id=rowid,
+            )
+            train_queue.record_usage(rowid, usage)
+        except Exception:
+            failed = True
+            log.exception('failed to train for user: {user}', user=user)
+        finally:
+            done.set()
+            heartbeat.join()
+            status = Status.failed if failed else Status.success
+            train_queue.update_status(
+                rowid,
+                status,
+                worker=worker,
+                reason=reason,
+            )
+
+        if on_job_finished is not None:
+            on_job_finished(user, status)
+
+
+def _collect_garbage(train_queue,
+                     replay_cache_dir,
+                     model_cache_dir,
+                     interval):
+    """Remove data which training no longer uses every ``interval`` seconds.
+    """
+    from .retention import collect_garbage
+
+    train_queue = train_queue.copy()
+    while True:
+        time.sleep(interval)
+        try:
+            collect_garbage(replay_cache_dir, model_cache_dir, train_queue)
+        except Exception:
+            log.exception('failed to collect garbage')
 
 
 def run_train_queue(train_queue,
                     replay_cache_dir,
                     model_cache_dir,
-                    client):
+                    client,
+                    preload_worker=False,
+                    workers=1,
+                    max_jobs_per_user=1,
+                    limits=None,
+                    parse_processes=1,
+                    gc_interval=None,
+                    drain=False,
+                    on_job_finished=None):
     """Run the train queue for ever, popping jobs and training the model
     for the user.
 
@@ -189,29 +1090,78 @@ def run_train_queue(train_queue,
         The root directory for all models.
     client : slider.Client
         The slider client to use when parsing replays.
+    preload_worker : bool, optional
+        Fork each job from a long-lived process which has already imported
+        the training dependencies instead of starting a new interpreter.
+    workers : int, optional
+        The number of jobs to run at once. Jobs are claimed atomically, so
+        many train services may also share one queue.
+    max_jobs_per_user : int, optional
+        The maximum number of jobs to run for a single user at once. Defaults
+        to 1 so that a user's jobs do not race on their model.
+    limits : JobLimits, optional
+        The resources each job may use. By default jobs are not limited.
+    parse_processes : int, optional
+        The number of processes each job parses replays with.
+    gc_interval : float, optional
+        The number of seconds between removing old models and archiving old
+        replays. By default this is not done by the train service.
+    drain : bool, optional
+        Return once no job can be claimed instead of waiting for more jobs.
+    on_job_finished : callable[str, Status], optional
+        Called with the user and status of each job after it finishes. This
+        is called from the worker threads.
     """
-    while True:
-        try:
-            rowid, user, agestr = train_queue.get_job()
-        except TrainQueue.Empty:
-            log.debug('no jobs')
-            sleep(1)
-            continue
+    preloaded = PreloadedTrainWorker() if preload_worker else None
+    job_args = (
+        replay_cache_dir,
+        model_cache_dir,
+        client,
+        preloaded,
+        limits,
+        parse_processes,
+    )
 
-        train_queue.update_status(rowid, Status.running)
-        try:
-            failed = _run_train_job(
-                user,
-                agestr,
+    if drain:
+        wakeup = None
+    else:
+        wakeup = train_queue.listen_for_jobs()
+        # Idle workers are woken when a job is enqueued. Still check the queue
+        # every so often to reclaim jobs whose lease has expired.
+        wakeup.settimeout(train_queue.lease_duration)
+
+    name = f'{socket.gethostname()}:{os.getpid()}'
+    threads = [
+        threading.Thread(
+            target=_train_worker,
+            args=(
+                train_queue,
+                wakeup,
+                f'{name}:{n}',
+                max_jobs_per_user,
+                job_args,
+                on_job_finished,
+            ),
+            daemon=True,
+        )
+        for n in range(workers)
+    ]
+    if gc_interval is not None:
+        threading.Thread(
+            target=_collect_garbage,
+            args=(
+                train_queue,
                 replay_cache_dir,
                 model_cache_dir,
-                client,
-            )
-        except Exception:
-            failed = True
-            log.exception('failed to train for user: {user}', user=user)
-        finally:
-            train_queue.update_status(
-                rowid,
-                Status.failed if failed else Status.success,
-            )
+                gc_interval,
+            ),
+            daemon=True,
+        ).start()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        if wakeup is not None:
+            train_queue.close_listener(wakeup)
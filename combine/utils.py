@@ -1,3 +1,7 @@
+from collections import OrderedDict, namedtuple
+import hashlib
+import json
+import os
 import pathlib
 import threading
 
@@ -23,6 +27,145 @@ def model_path(root, user):
     return root / user / str(ErrorModel.version)
 
 
+def training_state_path(root, user):
+    """Return the path to the record of the data a user's model was trained
+    on.
+
+    Parameters
+    ----------
+    root : path-like
+        The root model directory.
+    user : str
+        The user to get the training state path for.
+
+    Returns
+    -------
+    training_state_path : pathlib.Path
+        The path to the user's training state.
+    """
+    path = model_path(root, user)
+    return path.with_name(f'{path.name}.state.json')
+
+
+class TrainingState(namedtuple('TrainingState', (
+        'fingerprint',
+        'digests',
+        'incremental_runs',
+))):
+    """The record of the data a user's model was trained on.
+
+    Parameters
+    ----------
+    fingerprint : str
+        The ``training_fingerprint`` of the replays.
+    digests : frozenset[str]
+        The digests of the replays the model has been trained on.
+    incremental_runs : int
+        The number of incremental training runs since the model was last
+        trained from scratch.
+    """
+
+    @classmethod
+    def read(cls, root, user):
+        """Read a user's training state.
+
+        Parameters
+        ----------
+        root : path-like
+            The root model directory.
+        user : str
+            The user to read the training state for.
+
+        Returns
+        -------
+        state : TrainingState or None
+            The training state, or None if there is no valid state.
+        """
+        try:
+            with open(training_state_path(root, user)) as f:
+                raw = json.load(f)
+            return cls(
+                fingerprint=raw['fingerprint'],
+                digests=frozenset(raw['digests']),
+                incremental_runs=raw['incremental_runs'],
+            )
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return None
+
+    def write(self, root, user):
+        """Atomically write a user's training state.
+
+        Parameters
+        ----------
+        root : path-like
+            The root model directory.
+        user : str
+            The user to write the training state for.
+        """
+        path = training_state_path(root, user)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(
+                {
+                    'fingerprint': self.fingerprint,
+                    'digests': sorted(self.digests),
+                    'incremental_runs': self.incremental_runs,
+                },
+                f,
+            )
+        os.rename(tmp_path, path)
+
+
+def training_fingerprint(digests):
+    """Fingerprint the input to a training job.
+
+    Parameters
+    ----------
+    digests : iterable[str]
+        The digests of the replays being trained on.
+
+    Returns
+    -------
+    fingerprint : str
+        A hash of the replays and the model version.
+    """
+    sha256 = hashlib.sha256(f'{ErrorModel.version}\n'.encode('ascii'))
+    for digest in sorted(digests):
+        sha256.update(f'{digest}\n'.encode('ascii'))
+    return sha256.hexdigest()
+
+
+def model_version(root, user):
+    """Return a string which changes whenever a user's model is retrained.
+
+    Parameters
+    ----------
+    root : path-like
+        The root model directory.
+    user : str
+        The user to get the model version for.
+
+    Returns
+    -------
+    version : str
+        The model version.
+
+    Raises
+    ------
+    KeyError
+        Raised when the user does not have a model.
+    """
+    try:
+        mtime = max(
+            entry.stat().st_mtime_ns
+            for entry in os.scandir(model_path(root, user))
+        )
+    except (FileNotFoundError, ValueError):
+        raise KeyError(user)
+
+    return f'{ErrorModel.version}-{mtime}'
+
+
 def instance(cls):
     """Create a new instance of a class.
 
@@ -58,3 +201,58 @@ class LockedIterator:
     def __next__(self):
         with self._lock:
             return next(self._iterator)
+
+
+class LRUCache:
+    """A thread-safe mapping which holds at most ``maxsize`` entries. When the
+    cache is full, the least recently used entry is evicted.
+
+    Parameters
+    ----------
+    maxsize : int or None
+        The maximum number of entries to hold. None will hold all entries.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._entries[key]
+            self._entries.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            entries = self._entries
+            entries[key] = value
+            entries.move_to_end(key)
+            if self.maxsize is not None:
+                while len(entries) > self.maxsize:
+                    entries.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._entries[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        with self._lock:
+            return self._entries.pop(key, *default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()